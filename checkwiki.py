@@ -1,9 +1,19 @@
 #!/usr/bin/python
+import atexit
+import difflib
+import heapq
+import os
 import re
+import time
+
+from multiprocessing import Pool
+from queue import Empty, Queue
+from threading import Thread
 
 import pywikibot
+import requests
 
-from pywikibot import pagegenerators
+from pywikibot import pagegenerators, xmlreader
 from pywikibot.exceptions import UnknownExtension
 
 from checkwiki_errors import *
@@ -104,6 +114,91 @@ class CheckWikiErrorGenerator:
                     yield from self.checkwiki.iter_pages(error)
 
 
+class CheckWikiMarker:
+
+    '''
+    Client marking errors as fixed on the CheckWiki server
+
+    Requests are queued and sent from a background thread through its
+    own session. Requests waiting in the queue are merged so that no error
+    is marked twice, failed requests are retried with exponential
+    backoff.
+    '''
+
+    retries = 3
+    backoff = 2  # seconds
+    timeout = 30  # seconds
+
+    def __init__(self, url):
+        self.url = url
+        self.queue = Queue()
+        self.marked = set()
+        self.thread = Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def mark(self, project, title, errors):
+        self.queue.put((project, title, tuple(errors)))
+
+    def work(self):
+        # sessions are not thread-safe, this one is only used here
+        with requests.Session() as session:
+            self.process(session)
+
+    def process(self, session):
+        stop = False
+        while not stop:
+            pending = {}
+            item = self.queue.get()
+            while True:
+                if item is None:
+                    stop = True
+                else:
+                    project, title, errors = item
+                    pending.setdefault((project, title), set()).update(errors)
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    break
+
+            for (project, title), errors in pending.items():
+                for error in sorted(errors):
+                    key = (project, title, error)
+                    if key not in self.marked and self.send(session, *key):
+                        self.marked.add(key)
+
+    def send(self, session, project, title, error):
+        data = {
+            'action': 'mark',
+            'id': error,
+            'project': project,
+            'title': title,
+        }
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = session.post(
+                    self.url, data, timeout=self.timeout)
+            except requests.RequestException as exc:
+                problem = exc
+                continue
+            if response.ok:
+                return True
+            problem = f'HTTP {response.status_code}'
+            if response.status_code < 500 and response.status_code != 429:
+                break  # the request itself is wrong
+
+        pywikibot.error(
+            f'Failed to mark error {error} on {title} as fixed: {problem}')
+        return False
+
+    def close(self):
+        '''Wait until all queued requests are sent'''
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
 class CheckWiki:
 
     url = 'https://tools.wmflabs.org/checkwiki/cgi-bin/checkwiki_bots.cgi'
@@ -156,11 +251,19 @@ class CheckWiki:
         104: ReferenceQuotes,
     }
 
-    def __init__(self, site):
+    def __init__(self, site, url=None):
+        if url:
+            self.url = url
         self.site = site
+        self._marker = None
+        self._session = None
 
     def purge(self):
         self.__cache = {}
+        self.__plans = {}
+        self.__scanner = None
+        # fail early if errors depend on each other
+        self.get_plan(())
 
     @property
     def site(self):
@@ -170,7 +273,8 @@ class CheckWiki:
     def site(self, value):
         self._site = value
         self.purge()
-        self.load_settings()
+        # settings are loaded when needed
+        self.__dict__.pop('_settings', None)
 
     def load_settings(self):
         pywikibot.info('Loading CheckWiki settings...')
@@ -183,7 +287,11 @@ class CheckWiki:
         return self._settings
 
     def get_error(self, number):
-        return self.__cache.setdefault(number, self.errorMap[number](self))
+        '''Return the error instance, errors are created once per site'''
+        error = self.__cache.get(number)
+        if error is None:
+            error = self.__cache[number] = self.errorMap[number](self)
+        return error
 
     def iter_errors(self, numbers=None, only_for_fixes=False, priorities=None):
         for num in self.errorMap:
@@ -198,24 +306,89 @@ class CheckWiki:
 
             yield error
 
-    def apply(self, text, page, replaced=[], fixed=[], errors=[], **kwargs):
-        # todo: use a graph algorithm
-        errors = list(self.iter_errors(set(errors)))
-        while errors:
-            error = errors.pop(0)
-            if error.needsDecision() or error.handledByCC():  # todo
-                continue
+    def schedule(self, numbers):
+        '''
+        Order errors so that each runs after the errors in its needsFirst
 
-            numbers = [err.number for err in errors]
-            i = max([numbers.index(num) for num in error.needsFirst
-                     if num in numbers] + [0])
-            if i > 0:
-                errors.insert(i, error)
-                continue
+        Uses Kahn's algorithm, errors which do not depend on each other
+        keep the order of errorMap.
+
+        :raises ValueError: errors depend on each other in a cycle
+        '''
+        errors = list(self.iter_errors(numbers))
+        position = {error.number: i for i, error in enumerate(errors)}
+        dependents = {error.number: [] for error in errors}
+        pending = {}
+        for error in errors:
+            needs = {num for num in error.needsFirst if num in position}
+            pending[error.number] = len(needs)
+            for num in needs:
+                dependents[num].append(error)
+
+        queue = [position[error.number] for error in errors
+                 if not pending[error.number]]
+        heapq.heapify(queue)
+        plan = []
+        while queue:
+            error = errors[heapq.heappop(queue)]
+            plan.append(error)
+            for dependent in dependents[error.number]:
+                pending[dependent.number] -= 1
+                if not pending[dependent.number]:
+                    heapq.heappush(queue, position[dependent.number])
+
+        if len(plan) < len(errors):
+            cycle = sorted(num for num, count in pending.items() if count)
+            raise ValueError(
+                f'CheckWiki errors {cycle} are in or depend on a cycle')
+        return plan
+
+    def get_plan(self, numbers):
+        '''Return the errors to apply in order, cached per set of numbers'''
+        key = frozenset(numbers)
+        plan = self.__plans.get(key)
+        if plan is None:
+            plan = self.__plans[key] = [
+                error for error in self.schedule(key)
+                if not (error.needsDecision() or error.handledByCC())]  # todo
+        return plan
+
+    def get_scanner(self):
+        if self.__scanner is None:
+            tokens = {token for cls in self.errorMap.values()
+                      for token in cls.triggers}
+            # at each position, the regex only reports the longest token
+            implied = {token: {other for other in tokens if other in token}
+                       for token in tokens}
+            regex = re.compile('(?=(%s))' % '|'.join(
+                map(re.escape, sorted(tokens, key=len, reverse=True))))
+            self.__scanner = (regex, implied)
+        return self.__scanner
+
+    def scan(self, text):
+        '''Return triggers of errors found in text in a single pass'''
+        regex, implied = self.get_scanner()
+        tokens = set()
+        for token in set(regex.findall('\n' + text.lower())):
+            tokens.update(implied[token])
+        return tokens
+
+    def detect(self, text, page, errors=()):
+        '''Return numbers of errors present in text'''
+        tokens = self.scan(text)
+        return [error.number for error in self.get_plan(errors)
+                if error.is_triggered(tokens) and error.detect(text, page)]
 
+    def apply(self, text, page, replaced=[], fixed=[], errors=[], **kwargs):
+        tokens = self.scan(text)
+        for error in self.get_plan(errors):
+            if not error.is_triggered(tokens):
+                continue
             new_text = error.apply(text, page)
             if new_text != text:
                 text = new_text
+                # the fix could have added or removed triggers
+                tokens = self.scan(text)
                 summary = error.summary
                 fixed.append(error.number)
                 if summary not in replaced:
@@ -236,24 +409,43 @@ class CheckWiki:
         for title in self.iter_titles(num, **kwargs):
             yield pywikibot.Page(self.site, title)
 
+    @property
+    def marker(self):
+        if self._marker is None:
+            self._marker = CheckWikiMarker(self.url)
+            atexit.register(self._marker.close)
+        return self._marker
+
+    @property
+    def session(self):
+        '''Session for requests from the main thread'''
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+
     def get(self, data, **kwargs):
-        return requests.get(self.url, data, **kwargs)
+        kwargs.setdefault('timeout', CheckWikiMarker.timeout)
+        return self.session.get(self.url, params=data, **kwargs)
 
     def post(self, data, **kwargs):
-        return requests.post(self.url, data, **kwargs)
+        kwargs.setdefault('timeout', CheckWikiMarker.timeout)
+        return self.session.post(self.url, data, **kwargs)
 
     def mark_as_fixed(self, page, error):
-        data = {
-            'action': 'mark',
-            'id': error,
-            'project': page.site.dbName(),
-            'title': page.title(),
-        }
-        return self.post(data)
+        self.mark_as_fixed_multiple(page, [error])
 
     def mark_as_fixed_multiple(self, page, errors):
-        for error in errors:
-            self.mark_as_fixed(page, error)
+        '''Queue marking errors on page as fixed, returns immediately'''
+        if errors:
+            self.marker.mark(page.site.dbName(), page.title(), errors)
+
+    def close(self):
+        if self._marker is not None:
+            self._marker.close()
+            self._marker = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     @staticmethod
     def parse_option(option):
@@ -267,9 +459,118 @@ class CheckWiki:
         return ids, priorities
 
 
+# state of dump checking worker processes
+_checkwiki = None
+_numbers = None
+
+
+def init_dump_worker(checkwiki, numbers):
+    global _checkwiki, _numbers
+    _checkwiki = checkwiki
+    _numbers = numbers
+
+
+def check_dump_entry(entry):
+    '''Return errors fixed in the text of a dump entry and the diff'''
+    title, text = entry
+    page = pywikibot.Page(_checkwiki.site, title)
+    fixed = []
+    try:
+        new_text = _checkwiki.apply(text, page, [], fixed, _numbers)
+    except Exception as exc:
+        return title, [], f'{exc.__class__.__name__}: {exc}'
+    if not fixed:
+        return title, [], None
+    diff = ''.join(
+        line if line.endswith('\n') else line + '\n'
+        for line in difflib.unified_diff(
+            text.splitlines(True), new_text.splitlines(True),
+            fromfile=title, tofile=title))
+    return title, fixed, diff
+
+
+class CheckWikiDumpScanner:
+
+    '''
+    Check all articles in a local XML dump for fixable errors
+
+    Writes titles of articles with each error to error-<number>.txt and
+    the proposed changes to proposed.diff in the output directory.
+    '''
+
+    def __init__(self, checkwiki, numbers, xml, output, processes=None):
+        self.checkwiki = checkwiki
+        self.numbers = numbers
+        self.xml = xml
+        self.output = output
+        self.processes = processes or os.cpu_count()
+
+    def entries(self):
+        dump = xmlreader.XmlDump(self.xml)
+        for entry in dump.parse():
+            if entry.ns == '0' and not entry.isredirect:
+                yield entry.title, entry.text
+
+    def run(self):
+        os.makedirs(self.output, exist_ok=True)
+        # fail on cyclic dependencies before starting the workers
+        plan = self.checkwiki.get_plan(self.numbers)
+        # prepare everything which needs the site once for all workers
+        self.checkwiki.settings
+        self.checkwiki.get_scanner()
+        for error in plan:
+            if hasattr(error, 'pattern'):
+                error.get_pattern()
+            error.get_exceptions()
+        lists = {error.number: open(
+            os.path.join(self.output, f'error-{error.number:03}.txt'), 'w',
+            encoding='utf-8') for error in plan}
+        counts = dict.fromkeys(lists, 0)
+        scanned = 0
+        try:
+            with open(os.path.join(self.output, 'proposed.diff'), 'w',
+                      encoding='utf-8') as diff_file, \
+                    Pool(self.processes, init_dump_worker,
+                         (self.checkwiki, self.numbers)) as pool:
+                for title, fixed, diff in pool.imap(
+                        check_dump_entry, self.entries(), chunksize=20):
+                    scanned += 1
+                    if not fixed:
+                        if diff:
+                            pywikibot.warning(f'Failed to check {title}: '
+                                              f'{diff}')
+                        continue
+                    for number in fixed:
+                        lists[number].write(title + '\n')
+                        counts[number] += 1
+                    diff_file.write(diff)
+        finally:
+            for file in lists.values():
+                file.close()
+
+        pywikibot.info(f'{scanned} articles checked')
+        for number, count in counts.items():
+            pywikibot.info(f'Error {number}: {count} articles')
+
+
 class CheckWikiBot(WikitextFixingBot):
 
+    '''
+    Bot fixing CheckWiki errors
+
+    Supported parameters:
+    * -detect - only report which errors are present on pages
+    * -xml: - check a local XML dump (can be compressed) offline instead
+    * -output: - directory for results of -xml
+    * -processes:# - how many processes should check the dump
+    * -url: - address of the CheckWiki server (e.g. a local one for
+      testing)
+    '''
+
     def __init__(self, checkwiki, numbers, **kwargs):
+        self.available_options.update({
+            'detect': False,
+        })
         kwargs['checkwiki'] = False
         super().__init__(**kwargs)
         self.checkwiki = checkwiki
@@ -277,6 +578,13 @@ class CheckWikiBot(WikitextFixingBot):
 
     def treat_page(self):
         page = self.current_page
+        if self.opt['detect']:
+            found = self.checkwiki.detect(page.text, page, self.numbers)
+            if found:
+                pywikibot.info(
+                    f"Errors found: {', '.join(map(str, found))}")
+            return
+
         replaced = []
         fixed = []
         text = self.checkwiki.apply(
@@ -291,6 +599,10 @@ class CheckWikiBot(WikitextFixingBot):
             return
         self.checkwiki.mark_as_fixed_multiple(page, numbers)
 
+    def teardown(self):
+        self.checkwiki.close()
+        super().teardown()
+
 
 def main(*args):
     options = {}
@@ -316,6 +628,16 @@ def main(*args):
         else:
             numbers.extend(checkwiki.parse_option(arg)[0])
 
+    if options.get('url'):
+        checkwiki.url = options.pop('url')
+
+    if options.get('xml'):
+        scanner = CheckWikiDumpScanner(
+            checkwiki, numbers, options['xml'],
+            options.get('output', 'checkwiki'), options.get('processes'))
+        scanner.run()
+        return
+
     if gens:
         genFactory.gens.extend(gens)
     generator = genFactory.getCombinedGenerator(preload=True)
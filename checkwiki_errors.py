@@ -15,9 +15,15 @@ class CheckWikiError:
     exceptions = ['ce', 'comment', 'graph', 'hiero', 'math', 'nowiki', 'pre',
                   'score', 'startspace', 'syntaxhighlight']
     needsFirst = []
+    # lowercase strings of which at least one must be in a text with
+    # the error (empty if there is no such string)
+    triggers = ()
 
     def __init__(self, checkwiki):
         self.checkwiki = checkwiki
+        # instances live as long as the site of checkwiki does not change
+        self._pattern = None
+        self._exceptions = None
 
     @property
     def site(self):
@@ -27,16 +33,40 @@ class CheckWikiError:
     def settings(self):
         return self.checkwiki.settings
 
+    def get_pattern(self):
+        '''Return the compiled pattern, it is only built once'''
+        if self._pattern is None:
+            self._pattern = self.pattern()
+        return self._pattern
+
+    def get_exceptions(self):
+        '''Return the compiled exceptions, they are only built once'''
+        if self._exceptions is None:
+            self._exceptions = textlib._get_regexes(
+                self.exceptions, self.site)
+        return self._exceptions
+
     def apply(self, text, page):
-        return textlib.replaceExcept(text, self.pattern(), self.replacement,
-                                     self.exceptions, site=page.site)
+        return textlib.replaceExcept(text, self.get_pattern(),
+                                     self.replacement, self.get_exceptions())
+
+    def is_triggered(self, tokens):
+        '''Return whether the error can be in a text with tokens found'''
+        return not self.triggers or not tokens.isdisjoint(self.triggers)
+
+    def detect(self, text, page):
+        '''Return whether the error is present in text'''
+        if (type(self).apply is CheckWikiError.apply
+                and not self.get_pattern().search(text)):
+            return False
+        return self.apply(text, page) != text
 
     def isForFixes(self):  # todo: per subclass
         return hasattr(self, 'pattern') and hasattr(self, 'replacement')
 
     def toTuple(self):
         assert self.isForFixes()
-        return (self.pattern().pattern, self.replacement)
+        return (self.get_pattern().pattern, self.replacement)
 
     def needsDecision(self):  # todo: per subclass, user_interactor
         return False
@@ -54,6 +84,7 @@ class CCHandledError(CheckWikiError):
 class HeaderError(CheckWikiError):
 
     summary = 'oprava nadpisu'
+    triggers = ('\n=',)
 
     def pattern(self):
         return re.compile('(?m)^(?P<start>==+)(?P<content>((?!==|= *$).)+?)(?P<end>==+) *$')
@@ -65,8 +96,8 @@ class TagReplacement(CheckWikiError):
     tag = None  # extend
 
     def pattern(self):
-        # fixme
-        return re.compile(r'(?s)<(?P<tag>%s)>(?P<content>.*?)</(?P=tag)>')
+        return re.compile(r'(?s)<(?P<tag>%s)>(?P<content>.*?)</(?P=tag)>'
+                          % self.tag)
 
 
 class EntityReplacement(CheckWikiError):
@@ -114,9 +145,17 @@ class BrokenHTMLTag(CheckWikiError):
 
     number = 2
     summary = 'oprava chybné syntaxe HTML tagu'
+    triggers = ('/>', 'br', 'hr')
     tags = ('abbr', 'b', 'big', 'blockquote', 'center', 'cite', 'del', 'div',
             'em', 'font', 'i', 'p', 's', 'small', 'span', 'strike', 'sub',
             'sup', 'table', 'td', 'th', 'tr', 'tt', 'u')
+    param_regex = re.compile(
+        '(?P<param>[a-z]+) *= *'
+        '(?P<quote>[\'"])?'
+        r'(?P<content>(?(quote)(?!(?P=quote)|>).|\w)+)'
+        '(?(quote)(?P=quote)|)')
+    tag_regex = re.compile(
+        '<(?P<tag>%s)(?: (?P<params>[^>]+?))? */>' % '|'.join(tags))
 
     def pattern(self):
         return re.compile(r'< */+ *([bh]r)[ /]*>')
@@ -125,11 +164,7 @@ class BrokenHTMLTag(CheckWikiError):
         return match.expand(r'<\1 />')
 
     def apply(self, text, page):
-        param_regex = re.compile(
-            '(?P<param>[a-z]+) *= *'
-            '(?P<quote>[\'"])?'
-            r'(?P<content>(?(quote)(?!(?P=quote)|>).|\w)+)'
-            '(?(quote)(?P=quote)|)')
+        param_regex = self.param_regex
 
         def replaceTag(match):
             tag = match['tag']
@@ -162,9 +197,7 @@ class BrokenHTMLTag(CheckWikiError):
 
             return match.group()
 
-        text = re.sub(
-            '<(?P<tag>%s)(?: (?P<params>[^>]+?))? */>' % '|'.join(self.tags),
-            replaceTag, text)
+        text = self.tag_regex.sub(replaceTag, text)
 
         return super().apply(text, page)
 
@@ -176,7 +209,7 @@ class LowHeadersLevel(HeaderError):
     summary = 'oprava úrovní nadpisů'
 
     def apply(self, text, page):
-        regex = self.pattern()
+        regex = self.get_pattern()
         min_level = 8
         for match in regex.finditer(text):
             start, end = match.group('start', 'end')
@@ -199,6 +232,7 @@ class MissingEquation(CheckWikiError):
 
     number = 8
     summary = 'oprava úrovně nadpisů'
+    triggers = ('\n=',)
 
     def pattern(self):
         return re.compile(
@@ -341,6 +375,7 @@ class HTMLEntity(EntityReplacement):
     known = {'amp', 'dagger', 'Dagger', 'gt', 'lt', 'mdash', 'ndash', 'nbsp',
              'quot'}
     number = 11
+    triggers = ('&',)
 
     def pattern(self):
         return re.compile('&(?P<entity>[A-Za-z0-9]+);')
@@ -395,11 +430,12 @@ class SingleEquationHeader(HeaderError):
 
 class Dagger(EntityReplacement):
 
-    entity_map = {
+    entities_map = {
         'dagger': '†',
         'Dagger': '‡',
     }
     number = 20
+    triggers = ('&dagger;',)
 
 
 class EnglishCategory(CCHandledError):
@@ -455,7 +491,7 @@ class HeaderHierarchy(HeaderError):
     summary = 'oprava úrovně nadpisu'
 
     def apply(self, text, page):
-        regex = self.pattern()
+        regex = self.get_pattern()
         levels = []
         for match in regex.finditer(text):
             level = len(match['start'])
@@ -575,6 +611,7 @@ class StrikedText(TagReplacement):
     needsFirst = [2]
     number = 42
     tag = 'strike'
+    triggers = ('<strike',)
 
     def replacement(self, match):
         return match.expand(r'<s>\g<content></s>')
@@ -597,6 +634,10 @@ class BoldHeader(HeaderError):
 
 class SelfLink(CheckWikiError):
 
+    exceptions = list(set(CheckWikiError.exceptions + [
+        'imagemap', 'includeonly', 'timeline']) - {'startspace'})
+    link_regex = re.compile(
+        r"(?P<before>''')?\[\[(?P<inside>[^]]+)\]\](?P<after>''')?")
     needsFirst = [103]
     number = 48
     summary = 'odstranění odkazu na sebe'
@@ -622,12 +663,10 @@ class SelfLink(CheckWikiError):
         return match.group()
 
     def apply(self, text, page):
-        exceptions = list(set(self.exceptions + [
-            'imagemap', 'includeonly', 'timeline']) - {'startspace'})
         title = page.title()
         return textlib.replaceExcept(
-            text, r"(?P<before>''')?\[\[(?P<inside>[^]]+)\]\](?P<after>''')?",
-            lambda m: self.replacement(m, title), exceptions, site=page.site)
+            text, self.link_regex, lambda m: self.replacement(m, title),
+            self.get_exceptions())
 
 
 class HTMLHeader(CCHandledError):
@@ -642,6 +681,7 @@ class EntitesAsDashes(EntityReplacement):
         'ndash': '–',
     }
     number = 50
+    triggers = ('&mdash;', '&ndash;')
 
 
 class InterwikiBeforeHeader(CCHandledError):
@@ -661,9 +701,11 @@ class InterwikiBeforeCategory(CCHandledError):
 
 class ListWithBreak(CheckWikiError):
 
+    break_regex = re.compile(r'(?: *<[ /\\]*br[ /\\]*> *)+$')
     list_chars = ':*#'
     number = 54
     summary = 'odstranění zb. zalomení'
+    triggers = ('br',)
 
     def pattern(self):
         return re.compile(f'(?m)^[{self.list_chars}]+.*$')
@@ -671,7 +713,7 @@ class ListWithBreak(CheckWikiError):
     def replacement(self, match):
         line = match.group()
         if line.count('{{') == line.count('}}'):
-            return re.sub(r'(?: *<[ /\\]*br[ /\\]*> *)+$', '', line)
+            return self.break_regex.sub('', line)
         else:
             return line
 
@@ -698,6 +740,7 @@ class ParameterWithBreak(CheckWikiError):
     number = 59
     regex = re.compile(r'(?: *<[ /]*br[ /]*> *)+(?P<after>\s*)$')
     summary = 'odstranění zb. zalomení'
+    triggers = ('br',)
 
     def replacement(self, match):
         if match.group('unhandled_depth'):
@@ -733,22 +776,24 @@ class RefBeforePunctuation(CheckWikiError):
 
     number = 61
     punct = '.,:;'
+    punct_regex = re.compile(f'[{punct} ]+$')
+    ref_regex = re.compile('[%s]+ *(?:<ref(?= |>)[^>]*'
+                           '(?: ?/|>(?:(?!</?ref).)+</ref)>[%s ]*)+' % (
+                               punct, punct),
+                           re.S)
     summary = 'oprava interpunkce'
+    triggers = ('<ref',)
 
     # note that this is in general very controversial "error"
     # this algorithm only fixes punctuation when it's both before and after reference
     def apply(self, text, page):
-        ref_regex = re.compile('[%s]+ *(?:<ref(?= |>)[^>]*'
-                               '(?: ?/|>(?:(?!</?ref).)+</ref)>[%s ]*)+' % (
-                                   self.punct, self.punct),
-                               re.S)
-        return ref_regex.sub(self.replacement, text)
+        return self.ref_regex.sub(self.replacement, text)
 
     def replacement(self, match):
         if match.group().startswith(';') and match.string[match.start()-1] == '\n':
             return match.group()
 
-        regex = re.compile(f'[{self.punct} ]+$')
+        regex = self.punct_regex
         positions = []
         all_punct = []
         for ref in re.finditer('<ref', match.group()):
@@ -798,7 +843,9 @@ class RefBeforePunctuation(CheckWikiError):
 class SmallInsideTags(CheckWikiError):
 
     number = 63
+    small_regex = re.compile('</?small>')
     summary = 'oprava zmenšení textu uvnitř jiných značek'
+    triggers = ('small>',)
     tags = ('ref', 'sub', 'sup')
 
     def pattern(self):
@@ -809,7 +856,7 @@ class SmallInsideTags(CheckWikiError):
 
     def replacement(self, match):
         content = match.group('content')
-        new_content = re.sub('</?small>', '', content)
+        new_content = self.small_regex.sub('', content)
         if new_content != content:
             content = new_content.strip()
         tag = match['tag']
@@ -819,6 +866,7 @@ class SmallInsideTags(CheckWikiError):
 
 class BadListStructure(CheckWikiError):  # todo
 
+    line_regex = re.compile('^.*$', re.M)
     list_chars = ':*#'
     number = 75
     summary = 'oprava odsazení seznamu'
@@ -865,10 +913,9 @@ class BadListStructure(CheckWikiError):  # todo
 
     def apply(self, text, page):
         levels = ['']
-        regex = re.compile('^.*$', re.M)
         return textlib.replaceExcept(
-            text, regex, lambda match: self.replace(match, levels),
-            self.exceptions[:], site=self.site)
+            text, self.line_regex, lambda match: self.replace(match, levels),
+            self.get_exceptions())
 
 
 class NoSpace(CheckWikiError): # todo
@@ -880,6 +927,7 @@ class BrokenExternalLink(CheckWikiError): # todo
 
     number = 80
     summary = 'oprava externího odkazu'
+    triggers = ('[http',)
 
     def pattern(self):
         return re.compile(r'\[(?P<link>https?://[^][\n<]+)'
@@ -905,19 +953,21 @@ class DuplicateReferences(CheckWikiError):
     exceptions = CheckWikiError.exceptions[:] + ['references']
     needsFirst = [104]
     number = 81
+    param_regex = re.compile(
+        '(?P<param>[a-z]+) *= *'
+        '(?P<quote>[\'"])?'
+        r'(?P<content>(?(quote)(?!(?P=quote)|>).|[\w-])+)'
+        '(?(quote)(?P=quote)|)')
+    ref_regex = re.compile(
+        '<ref(?= |>)(?P<params>[^>]*)'
+        '(?: ?/|>(?P<content>(?:(?!</?ref).)+)</ref)>',
+        re.S)
     summary = 'oprava duplicitních referencí'
+    triggers = ('<ref',)
 
     def apply(self, text, page):
-        ref_regex = re.compile(
-            '<ref(?= |>)(?P<params>[^>]*)'
-            '(?: ?/|>(?P<content>(?:(?!</?ref).)+)</ref)>',
-            re.S)
-
-        param_regex = re.compile(
-            '(?P<param>[a-z]+) *= *'
-            '(?P<quote>[\'"])?'
-            r'(?P<content>(?(quote)(?!(?P=quote)|>).|[\w-])+)'
-            '(?(quote)(?P=quote)|)')
+        ref_regex = self.ref_regex
+        param_regex = self.param_regex
 
         named_contents = {}
         duplicate_named_contents = {}
@@ -1061,6 +1111,8 @@ class EmptyTag(CheckWikiError):
 
     number = 85
     summary = 'odstranění prázdného tagu'
+    # the tags can contain whitespace
+    triggers = ('</',)
     tags = ('center', 'code', 'div', 'gallery', 'includeonly', 'noinclude',
             'onlyinclude', 'pre', 'ref', 'span')
 
@@ -1115,6 +1167,7 @@ class DoubleHttp(CheckWikiError):
     exceptions = list(set(CheckWikiError.exceptions) - {'startspace'})
     number = 93
     summary = 'oprava externího odkazu'
+    triggers = ('http',)
 
     def pattern(self):
         return re.compile('(?i)(?:https?:*/*){2,}')
@@ -1128,6 +1181,7 @@ class Ordinals(CheckWikiError):
     needsFirst = [81]
     number = 101
     summary = 'oprava řadových číslovek'
+    triggers = ('<sup>',)
 
     def pattern(self):
         return re.compile(r'(?i)([1-9]\d*)<sup>(st|nd|rd|th)</sup>')
@@ -1140,6 +1194,7 @@ class SuperfluousPipe(CheckWikiError):
 
     number = 103
     summary = 'odstranění zb. kouzelných slov'
+    triggers = ('{{!}}',)
 
     def pattern(self):
         return re.compile(r'\[\[([^]|[{}]+)\{\{!\}\}([^]|[{}]+)\]\]')
@@ -1151,7 +1206,13 @@ class SuperfluousPipe(CheckWikiError):
 class ReferenceQuotes(CheckWikiError):
 
     number = 104
+    param_regex = re.compile(
+        '(?P<param>[a-z]+) *= *(?P<starts>[\'"])?'
+        '(?(starts)(?P=starts)*)'
+        '(?P<content>(?:(?!(?(starts)(?P=starts)|[\'"=])).)*)'
+        '(?P<ends>[\'"]+)?')
     summary = 'oprava uvozovek v referencích'
+    triggers = ('<ref ',)
 
     def pattern(self):
         return re.compile('<ref (?P<params>((?! */>)[^>])+?)(?P<slash> ?/)?>')
@@ -1176,10 +1237,6 @@ class ReferenceQuotes(CheckWikiError):
                 content=p['content'].strip(),
                 quote=quote, param=p['param'])
 
-        params = re.sub('(?P<param>[a-z]+) *= *(?P<starts>[\'"])?'
-                        '(?(starts)(?P=starts)*)'
-                        '(?P<content>(?:(?!(?(starts)(?P=starts)|[\'"=])).)*)'
-                        '(?P<ends>[\'"]+)?',
-                        handleParam, match.group('params'))
+        params = self.param_regex.sub(handleParam, match.group('params'))
 
         return '<ref %s%s>' % (params, match.group('slash') or '')
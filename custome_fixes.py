@@ -6,7 +6,10 @@ For use in user_fixes.py, please add to the file:
 from scripts.myscripts.custome_fixes import lazy_fixes
 fixes.update((key, fix.dictForUserFixes()) for key, fix in lazy_fixes.items())
 """
+import atexit
 import re
+import sqlite3
+import time
 
 from collections import defaultdict
 from itertools import chain
@@ -21,7 +24,14 @@ from pywikibot.tools import first_lower, first_upper
 
 from checkwiki_errors import CheckWikiError
 from tools import deduplicate, FULL_ARTICLE_REGEX
-from typoloader import TypoRule, TyposLoader
+from typoloader import (
+    ProtectedRanges,
+    TypoRule,
+    TypoRuleIndex,
+    TypoRulePool,
+    TyposLoader,
+    apply_typo_rules,
+)
 
 
 class FixGenerator:
@@ -512,6 +522,43 @@ class InterwikiFix(Fix):
         summaries.append('odstranění interwiki')
 
 
+class RedirectStore:
+
+    '''Redirect targets kept on disk between runs'''
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS redirects (
+                title TEXT PRIMARY KEY, target TEXT, checked REAL)
+        ''')
+        self.db.commit()
+
+    def load(self, max_age):
+        '''Return fresh targets and titles of stale entries'''
+        fresh, stale = {}, set()
+        limit = time.time() - max_age
+        for title, target, checked in self.db.execute(
+                'SELECT title, target, checked FROM redirects'):
+            if checked < limit:
+                stale.add(title)
+            else:
+                fresh[title] = target
+        return fresh, stale
+
+    def update(self, targets):
+        '''Store targets of titles, None for titles which are no redirect'''
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR REPLACE INTO redirects VALUES (?, ?, ?)',
+            ((title, target, now) for title, target in targets.items()))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
 class RedirectFix(LazyFix):
 
     '''
@@ -519,10 +566,12 @@ class RedirectFix(LazyFix):
 
     Additional arguments:
     * -onlypiped - only fix links which include "|" (overriden by -always)
+    * -maxage:# - days after which stored redirect targets are checked again
     '''
 
     key = 'redirects'
     options = {
+        'maxage': 7,
         'onlypiped': False,
     }
     page_title = 'Wikipedista:PastoriBot/narovnaná přesměrování'
@@ -533,12 +582,23 @@ class RedirectFix(LazyFix):
     message = 'narovnání přesměrování'
 
     def generator(self):
-        for title in self.redirects:
-            yield from pywikibot.Page(self.site, title).backlinks(
-                followRedirects=False, filterRedirects=False, namespaces=0)
+        '''Yield each page linking to the redirects once'''
+        seen = set()
+        # the set shrinks when a listed page is found not to be a redirect
+        for title in sorted(self.redirects):
+            for page in pywikibot.Page(self.site, title).backlinks(
+                    followRedirects=False, filterRedirects=False,
+                    namespaces=0):
+                key = page.title()
+                if key not in seen:
+                    seen.add(key)
+                    self.linked[key] = {title}
+                    yield page
+                elif key in self.linked:  # not processed yet
+                    self.linked[key].add(title)
 
     def get_redirects(self):
-        redirects = []  # todo: set?
+        redirects = []
         pywikibot.info('Loading redirects')
         page = pywikibot.Page(self.site, self.page_title)
         text = page.text.partition('{{SHORTTOC}}\n')[2]
@@ -553,31 +613,127 @@ class RedirectFix(LazyFix):
 
     def load(self):
         self.cache = {}
-        self.redirects = self.get_redirects()
+        # redirects known to be linked from pages yielded by generator
+        self.linked = {}
+        self.redirects = set(self.get_redirects())
+        self.link_regex = re.compile(r'\[\[([^]|[<>]+)[]|]')
         pywikibot.info(f'{len(self.redirects)} redirects loaded')
 
+        self.store = RedirectStore(pywikibot.config.datafilepath(
+            f'redirects-{self.site.dbName()}.sqlite'))
+        atexit.register(self.store.close)
+        self.targets, stale = self.store.load(int(self.maxage) * 24 * 3600)
+        for title, target in self.targets.items():
+            if target is None:
+                self.redirects.discard(title)
+        stale = {title for title in stale if title in self.redirects}
+        if stale:
+            pywikibot.info(f'Refreshing {len(stale)} stored redirects')
+            self.resolve_redirects(stale)
+
+    @staticmethod
+    def normalize(link):
+        return first_upper(link.replace('_', ' ').strip())
+
+    def apply(self, page, summaries=[], callbacks=[]):
+        links = self.collect_links(page.text)
+        links.update(
+            link for link in self.linked.pop(page.title(), ())
+            if link in self.redirects and link not in self.cache
+            and self.normalize(link) not in self.targets)
+        self.resolve_redirects(links)
+        return super().apply(page, summaries, callbacks)
+
+    def collect_links(self, text):
+        links = set()
+        for match in self.link_regex.finditer(text):
+            link = match[1].replace('_', ' ').strip()
+            if link in self.redirects and link not in self.cache:
+                if self.normalize(link) not in self.targets:
+                    links.add(link)
+        return links
+
+    def resolve_redirects(self, links):
+        '''Resolve redirects with one API request per batch of links'''
+        if not links:
+            return
+        if self.site.has_right('apihighlimits'):
+            size = 500
+        else:
+            size = 50
+        links = sorted(links)
+        for i in range(0, len(links), size):
+            batch = links[i:i + size]
+            request = self.site.simple_request(
+                action='query', titles=batch, redirects=True)
+            data = request.submit()['query']
+            normalized = {item['from']: item['to']
+                          for item in data.get('normalized', [])}
+            redirects = {item['from']: item
+                         for item in data.get('redirects', [])}
+            missing = {page['title'] for page in data.get('pages', {}).values()
+                       if 'missing' in page or 'invalid' in page}
+            targets = {}
+            for link in batch:
+                title = normalized.get(link, link)
+                if title in redirects:
+                    item = redirects[title]
+                    if 'tointerwiki' in item:
+                        continue  # left for from_cache
+                    target = item['to']
+                    if item.get('tofragment'):
+                        target += '#' + item['tofragment']
+                    self.cache_target(link, target)
+                    targets[self.normalize(link)] = target
+                elif title in missing:
+                    pywikibot.warning(f'{title} does not exist')
+                    self.redirects.discard(link)
+                    targets[self.normalize(link)] = None
+                else:
+                    pywikibot.warning(f'{title} is not a redirect')
+                    self.redirects.discard(link)
+                    targets[self.normalize(link)] = None
+            self.store_targets(targets)
+
+    def store_targets(self, targets):
+        self.targets.update(targets)
+        self.store.update(targets)
+
+    def cache_target(self, link, title):
+        if link == first_lower(link):
+            self.cache[link] = first_lower(title)
+        else:
+            self.cache[link] = title
+
     def from_cache(self, link):
         link = link.replace('_', ' ').strip()  # todo: normalize completely
         if link not in self.redirects:
             return False
 
         if link not in self.cache:
+            title = self.normalize(link)
+            if title in self.targets:
+                if self.targets[title] is None:
+                    self.redirects.discard(link)
+                    return False
+                self.cache_target(link, self.targets[title])
+                return self.cache[link]
+
             page = pywikibot.Page(self.site, link)
             if not page.exists():
                 pywikibot.warning(f'{page.title()} does not exist')
-                self.redirects.remove(link)  # fixme: both cases
+                self.redirects.discard(link)
+                self.store_targets({title: None})
                 return False
             if not page.isRedirectPage():
                 pywikibot.warning(f'{page.title()} is not a redirect')
-                self.redirects.remove(link)  # fixme: both cases
+                self.redirects.discard(link)
+                self.store_targets({title: None})
                 return False
 
             target = page.getRedirectTarget()
-            title = target.title()
-            if link == first_lower(link):
-                self.cache[link] = first_lower(title)
-            else:
-                self.cache[link] = title
+            self.cache_target(link, target.title())
+            self.store_targets({title: target.title()})
 
         return self.cache[link]
 
@@ -682,6 +838,12 @@ class RefSortFix(LazyFix):
     def replacements(self):
         yield (FULL_ARTICLE_REGEX, self.replace)
 
+    def apply(self, page, summaries=[], callbacks=[]):
+        # without two references there is nothing to sort
+        if page.text.count('<ref') < 2:
+            return False
+        return super().apply(page, summaries, callbacks)
+
     def replace(self, match):
         text = match.group()
         if 'group=' in text or '<references>' in text: # todo
@@ -850,6 +1012,12 @@ class SectionsFix(LazyFix):
     def replace(self, match):
         text = match.group()
         code = self.parser.parse(text, skip_style_tags=True)
+        if not self.fix_sections(code):
+            return text
+        return str(code)
+
+    def fix_sections(self, code):
+        '''Reorganize closing sections in code, return whether touched'''
         sections = []
         for header in code.ifilter_headings():
             name = header.title.strip()
@@ -863,7 +1031,7 @@ class SectionsFix(LazyFix):
             else:
                 sections[:] = []
         if not sections:
-            return text
+            return False
 
         do_more = False
         first_index = min(code.nodes.index(sect['nodes'][0])
@@ -877,7 +1045,7 @@ class SectionsFix(LazyFix):
         self.clean_empty(sections, code, do_more)
         code.nodes[first_index:last_index] = [node for sect in sections
                                               for node in sect['nodes']]
-        return str(code)
+        return True
 
 
 class StyleFix(Fix):  # todo: split and delete
@@ -912,16 +1080,27 @@ class TemplateFix(LazyFix):
 
     key = 'templates'
     message = 'narovnání šablon'
+    regex = re.compile(
+        r'(?P<before>\{\{\s*)(?P<template>[^<>#{|}]+?)(?P<after>\s*[|}])')
 
     def load(self):
         self.cache = {}
         self.defaultsort = self.site.getmagicwords('defaultsort')
 
+    def apply(self, page, summaries=[], callbacks=[]):
+        # skip the page if all its templates are known not to redirect
+        names = set()
+        for match in self.regex.finditer(page.text):
+            name = match['template'].replace('_', ' ').strip()
+            if not name.startswith(tuple(self.defaultsort)):
+                names.add(first_upper(name).partition('<!--')[0])
+        if all(name in self.cache and not self.cache[name]
+               for name in names):
+            return False
+        return super().apply(page, summaries, callbacks)
+
     def replacements(self):
-        yield (
-            r'(?P<before>\{\{\s*)(?P<template>[^<>#{|}]+?)(?P<after>\s*[|}])',
-            self.replace,
-        )
+        yield (self.regex.pattern, self.replace)
 
     def replace(self, match):
         template_name = match['template'].replace('_', ' ').strip()
@@ -963,6 +1142,8 @@ class TypoFix(LazyFix):
     Additional arguments:
     * -maxsummarytypos - how many typo replacements to show in edit
       summary at most?
+    * -processes:# - apply automatic rules to long pages in parallel in
+      this many processes
     * -typospage
     * -whitelistpage
     '''
@@ -970,6 +1151,7 @@ class TypoFix(LazyFix):
     key = 'typos'
     options = {
         'maxsummarytypos': 5,
+        'processes': 1,
         'typospage': None,
         'whitelistpage': None,
     }
@@ -982,6 +1164,13 @@ class TypoFix(LazyFix):
     def load(self):
         loader = TyposLoader(self.site)
         self.typoRules = loader.loadTypos()
+        self.rule_index = TypoRuleIndex(self.typoRules)
+        self.ranges = ProtectedRanges(TypoRule.exceptions, self.site)
+        self.pool = None
+        if self.processes > 1:
+            self.pool = TypoRulePool(self.typoRules, TypoRule.exceptions,
+                                     self.site, self.processes)
+            atexit.register(self.pool.close)
         self.whitelist = loader.loadWhitelist()
 
     def generator(self):
@@ -997,13 +1186,10 @@ class TypoFix(LazyFix):
         title = page.title()
         if title in self.whitelist:
             return
-        text = page.text
         replaced = []
-        for rule in self.typoRules:
-            if rule.matches(title):
-                continue
-            text = rule.apply(text, replaced)
-        page.text = text
+        page.text = apply_typo_rules(
+            page.text, title, self.rule_index, self.ranges, replaced,
+            pool=self.pool)
         count = len(replaced)
         if count > 0:  # todo: separate function
             if count > 1:
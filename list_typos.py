@@ -1,20 +1,188 @@
 #!/usr/bin/python
+import json
+import os
 import re
+import sqlite3
+import time
 
 from collections import defaultdict
+from itertools import islice
+from multiprocessing import Array, Pool
 
 import pywikibot
 
-from pywikibot import textlib
+from pywikibot import textlib, xmlreader
 from pywikibot.bot import SingleSiteBot, ExistingPageBot
 from pywikibot.pagegenerators import PreloadingGenerator
 from pywikibot.tools.itertools import itergroup
 
-from typoloader import TypoRule, TyposLoader
+from tools import dump_stats
+from typoloader import TypoRule, TypoRuleIndex, TyposLoader, harvest_search
+
+
+# state of dump scanning worker processes
+_rules = None
+_index = None
+_exceptions = None
+_quarantined = None
+
+
+def init_dump_worker(rules, exceptions, quarantined):
+    global _rules, _index, _exceptions, _quarantined
+    _rules = rules
+    _index = TypoRuleIndex(rules)
+    _exceptions = exceptions
+    # flags shared by all workers, by position of the rule
+    _quarantined = quarantined
+
+
+def scan_dump_entry(entry):
+    '''
+    Return all typos found by the rules in the text of a dump entry
+
+    Statistics of the rules are collected in the worker, so they are
+    returned as well, as (rule id, time, number of matches, whether
+    the rule got quarantined).
+    '''
+    title, text, revid = entry
+    candidates = _index.candidates(text)
+    title_matches = _index.title_matches(title)
+    matches = []
+    stats = []
+    clean_text = None
+    for i, rule in enumerate(_rules):
+        if _quarantined[i]:
+            rule.quarantined = True
+            continue
+        if rule.id not in candidates or rule.id in title_matches:
+            continue
+        start = time.perf_counter()
+        count = 0
+        if next(rule.iter_unprotected(text), None):
+            if clean_text is None:
+                clean_text = textlib.removeDisabledParts(text, _exceptions)
+            found = set()
+            for match in rule.iter_unprotected(clean_text):
+                count += 1
+                if match[0] not in found:
+                    found.add(match[0])
+                    matches.append(match[0])
+        delta = time.perf_counter() - start
+        if delta > rule.time_budget:
+            rule.quarantine(delta)
+        if rule.quarantined:
+            _quarantined[i] = True
+        stats.append((rule.id, delta, count, rule.quarantined))
+    return title, revid, matches, stats
+
+
+class ReportSpool:
+
+    '''
+    Append-only file with lines of the report and an index of its entries
+
+    The index is a SQLite database which holds reported typos of each page
+    (so that they are not repeated), scanned pages and the length of the
+    file when they were committed, so that an interrupted run can be
+    resumed.
+    '''
+
+    commit_every = 100
+
+    def __init__(self, path, page, resume=False):
+        self.path = path
+        self.index = sqlite3.connect(path + '.sqlite')
+        self.index.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            CREATE TABLE IF NOT EXISTS typos (
+                link TEXT, match TEXT, PRIMARY KEY (link, match));
+            CREATE TABLE IF NOT EXISTS pages (
+                title TEXT PRIMARY KEY, revid INTEGER);
+        ''')
+        meta = dict(self.index.execute('SELECT key, value FROM meta'))
+        if resume and meta.get('page') == page:
+            self.position = meta.get('position', 0)
+            offset = meta.get('offset', 0)
+            pywikibot.info(f'Resuming report with {self.count_pages()} '
+                           'scanned pages')
+        else:
+            self.index.executescript('''
+                DELETE FROM meta; DELETE FROM typos; DELETE FROM pages;
+            ''')
+            self.index.execute(
+                'INSERT INTO meta VALUES (?, ?)', ('page', page))
+            self.index.commit()
+            self.position = offset = 0
+        # drop lines written after the last commit
+        self.file = open(path, 'a+', encoding='utf-8')
+        self.file.seek(offset)
+        self.file.truncate()
+        self.pending = 0
+
+    def count_pages(self):
+        return self.index.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def is_done(self, title):
+        cursor = self.index.execute(
+            'SELECT 1 FROM pages WHERE title = ?', (title,))
+        return cursor.fetchone() is not None
+
+    def add(self, link, match_text, line):
+        '''Append line to the report unless the typo is already there'''
+        cursor = self.index.execute(
+            'INSERT OR IGNORE INTO typos VALUES (?, ?)', (link, match_text))
+        if cursor.rowcount < 1:
+            return False
+        self.file.write(line + '\n')
+        return True
+
+    def finish_page(self, title, revid=None):
+        self.index.execute(
+            'INSERT OR REPLACE INTO pages VALUES (?, ?)', (title, revid))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.file.flush()
+        self.index.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [
+            ('offset', self.file.tell()), ('position', self.position)])
+        self.index.commit()
+        self.pending = 0
+
+    def lines(self):
+        self.commit()
+        self.file.seek(0)
+        for line in self.file:
+            yield line.rstrip('\n')
+
+    def revisions(self):
+        return dict(self.index.execute(
+            'SELECT title, revid FROM pages WHERE revid IS NOT NULL'))
+
+    def close(self, remove=False):
+        self.commit()
+        self.file.close()
+        self.index.close()
+        if remove:
+            os.remove(self.path)
+            os.remove(self.path + '.sqlite')
 
 
 class TypoReportBot(SingleSiteBot):
 
+    '''
+    Bot listing typos found by the typo rules on a page
+
+    The report is written to a local spool file as pages are scanned.
+
+    Supported parameters:
+    * -xml: - scan a local XML dump (can be compressed) instead of using
+      the search
+    * -processes:# - how many processes should scan the dump
+    * -resume - continue an interrupted run, skip pages it has scanned
+    '''
+
     pattern = '# {} \u2013 {}'
 
     def __init__(self, **kwargs):
@@ -22,6 +190,10 @@ class TypoReportBot(SingleSiteBot):
             'always': True,
             'anything': False,
             'outputpage': None,
+            'processes': os.cpu_count(),
+            'profile': None,
+            'resume': False,
+            'xml': None,
             'typospage': None,
             'whitelistpage': None,
             'false_positives': None,
@@ -35,10 +207,13 @@ class TypoReportBot(SingleSiteBot):
     def setup(self):
         super().setup()
         self.typoRules = self.loader.loadTypos()
+        self.rule_index = TypoRuleIndex(self.typoRules)
         #self.fp_page = self.loader.getWhitelistPage()
         self.whitelist = self.loader.loadWhitelist()
-        self.data = defaultdict(list)
-        self.order = []  # remove when dictionaries are ordered
+        self.spool = ReportSpool(
+            pywikibot.config.datafilepath(
+                f'typos-report-{self.site.dbName()}.spool'),
+            self.opt.outputpage, self.opt.resume)
         self.load_false_positives()
 
     def load_false_positives(self):
@@ -50,16 +225,71 @@ class TypoReportBot(SingleSiteBot):
             if line.startswith(('#', '*')):
                 fps.add(line.lstrip('#* '))
 
+    @property
+    def revisions_path(self):
+        return pywikibot.config.datafilepath(
+            f'typos-report-{self.site.dbName()}.json')
+
+    def load_revisions(self):
+        '''Return revision IDs of pages as they were scanned for the report'''
+        try:
+            with open(self.revisions_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get('page') != self.opt.outputpage:
+            return {}
+        return data['revisions']
+
+    def save_revisions(self, revisions):
+        with open(self.revisions_path, 'w', encoding='utf-8') as f:
+            json.dump({'page': self.opt.outputpage, 'revisions': revisions},
+                      f, ensure_ascii=False)
+
     @property
     def generator(self):
-        for rule in self.typoRules:
-            if rule.query is None:
-                continue
+        if self.opt.xml:
+            yield from self.dump_generator()
+            return
+
+        # each page is fetched once, for all rules which can match it
+        searched = [rule for rule in self.typoRules if rule.query is not None]
+        pages = (pywikibot.Page(self.site, title)
+                 for title, _ in harvest_search(self.site, searched)
+                 if not self.spool.is_done(title))
+        for page in PreloadingGenerator(pages):
+            candidates = self.rule_index.candidates(page.text)
+            self.current_rules = [rule for rule in searched
+                                  if rule.id in candidates]
+            yield page
 
-            pywikibot.info(f'Query: "{rule.query}"')
-            self.current_rule = rule
-            yield from PreloadingGenerator(
-                self.site.search(rule.query, namespaces=[0]))
+    def dump_generator(self):
+        dump = xmlreader.XmlDump(self.opt.xml)
+        # the order of the dump is stable, scanned entries can be skipped
+        start = self.spool.position
+        entries = islice(
+            ((entry.title, entry.text, int(entry.revisionid))
+             for entry in dump.parse()
+             if entry.ns == '0' and not entry.isredirect),
+            start, None)
+        exceptions = textlib._get_regexes(TypoRule.exceptions, self.site)
+        quarantined = Array('b', [rule.quarantined for rule in self.typoRules],
+                            lock=False)
+        with Pool(self.opt.processes, init_dump_worker,
+                  (self.typoRules, exceptions, quarantined)) as pool:
+            for i, (title, revid, matches, stats) in enumerate(pool.imap(
+                    scan_dump_entry, entries, chunksize=20), start=start + 1):
+                for rule_id, delta, count, stopped in stats:
+                    rule = self.rule_index.rules[rule_id]
+                    rule.record(delta)
+                    rule.match_count += count
+                    if stopped:
+                        rule.quarantine(delta)
+                if matches:
+                    self.current_matches = matches
+                    self.current_revid = revid
+                    yield pywikibot.Page(self.site, title)
+                self.spool.position = i
 
     def skip_page(self, page):
         # TODO: better terminology
@@ -67,11 +297,6 @@ class TypoReportBot(SingleSiteBot):
             pywikibot.warning(f'Skipped {page} because it is whitelisted')
             return True
 
-        if self.current_rule.find.search(page.title()):
-            pywikibot.warning(
-                f'Skipped {page} because the rule matches the title')
-            return True
-
         return super().skip_page(page)
 
     def remove_disabled_parts(self, text):
@@ -79,40 +304,88 @@ class TypoReportBot(SingleSiteBot):
             text, TypoRule.exceptions, site=self.site)
 
     def treat(self, page):
-        match = self.current_rule.find.search(page.text)
+        if self.opt.xml:
+            link = page.title(as_link=True)
+            found = False
+            for match_text in self.current_matches:
+                found = self.add_typo(link, match_text) or found
+            self.spool.finish_page(
+                page.title(), self.current_revid if found else None)
+            return
+
+        self.clean_text = None
+        self.found = False
+        title_matches = self.rule_index.title_matches(page.title())
+        for rule in self.current_rules:
+            if rule.quarantined:
+                continue
+            if rule.id in title_matches:
+                pywikibot.warning(
+                    f'Skipped rule "{rule.find.pattern}" on {page} because '
+                    'it matches the title')
+                continue
+            start = time.perf_counter()
+            try:
+                self.find_typos(page, rule)
+            finally:
+                delta = time.perf_counter() - start
+                rule.record(delta)
+                if delta > rule.time_budget:
+                    rule.quarantine(delta)
+        self.spool.finish_page(
+            page.title(), page.latest_revision_id if self.found else None)
+
+    def find_typos(self, page, rule):
+        match = rule.find.search(page.text)
         if not match:
             return
-        text = self.remove_disabled_parts(page.text)
+        if self.clean_text is None:
+            self.clean_text = self.remove_disabled_parts(page.text)
+        text = self.clean_text
         found = set()
-        for match in self.current_rule.find.finditer(text):
+        for match in rule.find.finditer(text):
+            rule.match_count += 1
             match_text = match[0]
             if match_text in found:
                 continue
             found.add(match_text)
-            link = page.title(as_link=True)
-            put_text = self.pattern.format(link, match_text)
-            if put_text[2:] not in self.false_positives:
-                pywikibot.stdout(put_text)
-                if not self.data.get(link):
-                    self.order.append(link)
-                self.data[link].append(match_text)
+            if self.add_typo(page.title(as_link=True), match_text):
+                rule.accepted_count += 1
+                self.found = True
+
+    def add_typo(self, link, match_text):
+        put_text = self.pattern.format(link, match_text)
+        if put_text[2:] in self.false_positives:
+            return False
+        if not self.spool.add(link, match_text, put_text):
+            return False
+        pywikibot.stdout(put_text)
+        return True
 
     def teardown(self):
         outputpage = self.opt.outputpage
-        if (self.generator_completed or self.opt.anything) and outputpage:
-            put = []
-            for link in self.order:
-                for match in self.data[link]:
-                    put.append(self.pattern.format(link, match))
+        completed = self.generator_completed or self.opt.anything
+        if completed and outputpage:
             page = pywikibot.Page(self.site, outputpage)
-            page.text = '\n'.join(put)
+            page.text = '\n'.join(self.spool.lines())
             page.save(summary='aktualizace seznamu překlepů', minor=False,
                       bot=False, apply_cosmetic_changes=False)
+            self.save_revisions(self.spool.revisions())
+        self.spool.close(remove=completed and bool(outputpage))
+        if self.opt.profile:
+            dump_stats([rule.get_stats() for rule in self.typoRules],
+                       self.opt.profile)
         super().teardown()
 
 
 class PurgeTypoReportBot(SingleSiteBot, ExistingPageBot):
 
+    '''
+    Bot removing fixed typos from the report
+
+    Only pages edited since they were scanned are downloaded again.
+    '''
+
     def __init__(self, **kwargs):
         self.helper = TypoReportBot(**kwargs)
         super().__init__(site=self.helper.site)
@@ -125,41 +398,76 @@ class PurgeTypoReportBot(SingleSiteBot, ExistingPageBot):
         self.generator = [pywikibot.Page(self.site, self.helper.opt.outputpage)]
         self.helper.load_false_positives()
 
-    def line_iterator(self, text):
+    def parse_lines(self, text):
+        '''Return lines of the report with the first entry of a page as Page'''
         regex = re.compile(self.helper.pattern.format(
             r'\[\[([^]]+)\]\]', '(.+)'))
+        lines = []
         for line in text.splitlines():
             match = regex.fullmatch(line)
             if match:
                 title, text = match.groups()
                 entry = pywikibot.Page(self.site, title)
+                if entry.title() not in self.cache:
+                    lines.append(entry)
                 self.cache[entry.title()].append(text)
-                yield entry
             else:
-                self.put.append(line)
+                lines.append(line)
+        return lines
+
+    def recheck(self, entry, revisions):
+        key = title = entry.title()
+        strings = self.cache.pop(key)
+        revisions.pop(key, None)
+        if not entry.exists():
+            return []
+        while entry.isRedirectPage():
+            entry = entry.getRedirectTarget()
+            title = entry.title()
+        text = self.helper.remove_disabled_parts(entry.text)
+        put = []
+        for string in strings:
+            if string in text:
+                put.append(self.helper.pattern.format(f'[[{title}]]', string))
+        if put:
+            revisions[title] = entry.latest_revision_id
+        return put
 
     def treat(self, page):
-        pattern = self.helper.pattern
-        for entry in PreloadingGenerator(self.line_iterator(page.text)):
-            key = title = entry.title()
-            if not entry.exists():
-                self.cache.pop(key)
+        lines = self.parse_lines(page.text)
+        entries = [line for line in lines if not isinstance(line, str)]
+        revisions = self.helper.load_revisions()
+        changed = []
+        for group in itergroup(entries, 500):
+            for entry in self.site.preloadpages(group, content=False):
+                if (not entry.exists() or entry.isRedirectPage()
+                        or revisions.get(entry.title())
+                        != entry.latest_revision_id):
+                    changed.append(entry)
+        pywikibot.info(
+            f'{len(changed)} of {len(entries)} pages changed since last scan')
+
+        rechecked = {}
+        for entry in PreloadingGenerator(changed):
+            rechecked[entry.title()] = self.recheck(entry, revisions)
+
+        for line in lines:
+            if isinstance(line, str):
+                self.put.append(line)
                 continue
-            while entry.isRedirectPage():
-                entry = entry.getRedirectTarget()
-                title = entry.title()
-            text = self.helper.remove_disabled_parts(entry.text)
-            for string in self.cache.pop(key):
-                if string not in text:
-                    continue
-                put_text = pattern.format(f'[[{title}]]', string)
-                if put_text[2:] in self.helper.false_positives:
-                    continue
-                self.put.append(put_text)
+            title = line.title()
+            if title in rechecked:
+                put = rechecked[title]
+            else:
+                put = [self.helper.pattern.format(f'[[{title}]]', string)
+                       for string in self.cache.pop(title)]
+            self.put.extend(text for text in put
+                            if text[2:] not in self.helper.false_positives)
 
         page.text = '\n'.join(self.put)
         page.save(summary='odstranění vyřešených překlepů', minor=True,
                   bot=True, apply_cosmetic_changes=False)
+        self.helper.save_revisions(revisions)
 
 
 def main(*args):
@@ -0,0 +1,113 @@
+import inspect
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import checkwiki_errors  # noqa: E402
+
+
+# texts with each error, keyed by the number of the error
+SAMPLES = {
+    2: ['a</br>b', 'a< / hr >b'],
+    7: ['=== a ===\ntext\n=== b ==='],
+    8: ['text\n== a'],
+    11: ['a&times;b'],
+    19: ['text\n= a =\ntext'],
+    20: ['a&dagger;b', 'a&Dagger;b'],
+    25: ['== a ==\ntext\n==== b ===='],
+    42: ['a<strike>b</strike>c'],
+    44: ["== '''a''' =="],
+    50: ['a&mdash;b', 'a&ndash;b'],
+    54: ['* a<br>', '# a <br />'],
+    57: ['== a: =='],
+    59: ['c<br>', 'c <br />\n'],
+    61: ['a.<ref>b</ref>. c'],
+    63: ['<ref><small>a</small></ref>', '<sup>a<small>b</small></sup>'],
+    80: ['[http://example.org a\n'],
+    81: ['<ref name="a">b</ref> <ref name="a">b</ref>'],
+    85: ['<div></div>', 'a\n<div> </div>\nb', '<ref>\n</ref>',
+         '<span>\n\n</span>'],
+    93: ['http://http://example.org'],
+    101: ['1<sup>st</sup>', '2<SUP>ND</SUP>'],
+    103: ['[[a{{!}}b]]'],
+    104: ['<ref name=a/>', "<ref name='a'>b</ref>"],
+}
+
+# errors which do not find the error by their pattern
+PATTERNS = {
+    59: 'regex',
+    61: 'ref_regex',
+    81: 'ref_regex',
+}
+
+
+class FakeCheckWiki:
+
+    site = None
+
+
+def scan(text, triggers):
+    '''Tokens of triggers found by CheckWiki.scan'''
+    text = '\n' + text.lower()
+    return {token for token in triggers if token in text}
+
+
+class TestTriggers(unittest.TestCase):
+
+    '''Test that triggers of errors do not skip texts with the error'''
+
+    def iter_errors(self):
+        for cls in vars(checkwiki_errors).values():
+            if (inspect.isclass(cls)
+                    and issubclass(cls, checkwiki_errors.CheckWikiError)
+                    and cls.triggers and getattr(cls, 'number', None)):
+                yield cls(FakeCheckWiki())
+
+    def test_samples_exist(self):
+        for error in self.iter_errors():
+            with self.subTest(error=error.number):
+                self.assertIn(error.number, SAMPLES)
+
+    def test_samples_triggered(self):
+        for error in self.iter_errors():
+            for text in SAMPLES.get(error.number, []):
+                with self.subTest(error=error.number, text=text):
+                    if error.number in PATTERNS:
+                        regex = getattr(error, PATTERNS[error.number])
+                    else:
+                        regex = error.get_pattern()
+                    self.assertIsNotNone(regex.search(text))
+                    self.assertTrue(
+                        error.is_triggered(scan(text, error.triggers)))
+
+
+class TestReplacements(unittest.TestCase):
+
+    '''Test replacements of errors made by their pattern'''
+
+    def assertReplaced(self, cls, text, expected):
+        error = cls(FakeCheckWiki())
+        self.assertEqual(
+            error.get_pattern().sub(error.replacement, text), expected)
+
+    def test_dagger(self):
+        self.assertReplaced(checkwiki_errors.Dagger,
+                            'a&dagger;b&Dagger;c', 'a†b‡c')
+
+    def test_striked_text(self):
+        self.assertReplaced(checkwiki_errors.StrikedText,
+                            'a<strike>x</strike>b', 'a<s>x</s>b')
+
+    def test_bold(self):
+        self.assertReplaced(checkwiki_errors.Bold,
+                            'a<b>x</b>b', "a'''x'''b")
+
+    def test_italics(self):
+        self.assertReplaced(checkwiki_errors.Italics,
+                            'a<i>x</i>b', "a''x''b")
+
+
+if __name__ == '__main__':
+    unittest.main()
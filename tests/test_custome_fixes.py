@@ -0,0 +1,42 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from custome_fixes import SectionsFix  # noqa: E402
+
+
+class FakePage:
+
+    def __init__(self, text):
+        self.text = text
+
+
+class TestSectionsFix(unittest.TestCase):
+
+    '''Test reordering closing sections'''
+
+    text = ('{{Infobox}}\nText\n\n'
+            '== Externí odkazy ==\n* a\n\n'
+            '== Reference ==\n<references />\n\n'
+            '== Reference ==\nb\n')
+
+    def setUp(self):
+        self.fix = SectionsFix()
+        self.fix._site = None  # the texts do not need the site
+        self.fix.load()
+
+    def test_reorder(self):
+        page = FakePage(self.text)
+        self.assertTrue(self.fix.apply(page))
+        self.assertLess(page.text.index('== Reference =='),
+                        page.text.index('== Externí odkazy =='))
+
+    def test_leading_comment(self):
+        page = FakePage('<!-- pozn -->' + self.text)
+        self.assertFalse(self.fix.apply(page))
+
+
+if __name__ == '__main__':
+    unittest.main()
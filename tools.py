@@ -1,3 +1,5 @@
+import csv
+import json
 import re
 
 import pywikibot
@@ -64,6 +66,35 @@ def parse_image(text, site):
     return image, caption
 
 
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = round(percent / 100 * (len(ordered) - 1))
+    return ordered[index]
+
+
+def dump_stats(rows, filename):
+    '''Dump list of dicts to filename as CSV (if it ends so) or JSON'''
+    if filename.endswith('.csv'):
+        with open(filename, 'w', encoding='utf-8', newline='') as f:
+            if rows:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+                writer.writeheader()
+                writer.writerows(rows)
+    else:
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+
+def load_stats(filename):
+    '''Load list of dicts dumped by dump_stats'''
+    with open(filename, encoding='utf-8', newline='') as f:
+        if filename.endswith('.csv'):
+            return list(csv.DictReader(f))
+        return json.load(f)
+
+
 def get_best_statements(statements):
     best = []
     best_rank = 'normal'
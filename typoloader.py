@@ -1,9 +1,24 @@
+import json
+import os
+import random
 import re
 import time
 
+from bisect import bisect_right
+from collections import defaultdict
+from multiprocessing import Pool
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
 import pywikibot
 
 from pywikibot import textlib
+from pywikibot.tools import first_upper
+
+from tools import load_stats, percentile
 
 
 class IncompleteTypoRuleException(Exception):
@@ -46,6 +61,8 @@ class TypoRule:
     ]
 
     nowikiR = re.compile('</?nowiki>')
+    time_budget = 5  # seconds per page
+    sample_size = 1000  # timings kept for percentiles
 
     def __init__(self, find, replacements, auto=False, query=None):
         self.find = find
@@ -53,6 +70,14 @@ class TypoRule:
         self.auto = auto
         self.query = query
         self.longest = 0
+        self.anchor = self.find_anchor(find)
+        self.risky = self.has_nested_quantifiers(find)
+        self.quarantined = False
+        self.calls = 0
+        self.total = 0.0
+        self.timings = []  # random sample of calls
+        self.match_count = 0
+        self.accepted_count = 0
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -69,9 +94,86 @@ class TypoRule:
             f'auto={self.auto!r}, query={self.query!r})'
         )
 
+    @staticmethod
+    def find_anchor(regex):
+        '''
+        Return the longest literal string every match of regex contains
+
+        Returns None if there is no such string or the expression is case
+        insensitive.
+        '''
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+        state = getattr(parsed, 'state', None) or parsed.pattern
+        if state.flags & re.I:
+            return None
+
+        runs = []
+        run = []
+
+        def walk(items):
+            for op, av in items:
+                if op is sre_parse.LITERAL:
+                    run.append(chr(av))
+                elif op in (sre_parse.AT, sre_parse.ASSERT,
+                            sre_parse.ASSERT_NOT):
+                    pass  # zero-width, literals around stay adjacent
+                elif op is sre_parse.SUBPATTERN and not av[1] & re.I:
+                    walk(av[-1])
+                elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) \
+                        and av[0] > 0:
+                    flush()
+                    walk(av[2])
+                    flush()
+                else:
+                    flush()
+
+        def flush():
+            if run:
+                runs.append(''.join(run))
+                run.clear()
+
+        walk(parsed)
+        flush()
+        return max(runs, key=len, default=None)
+
+    @staticmethod
+    def has_nested_quantifiers(regex):
+        '''
+        Return whether regex repeats an unbounded repetition
+
+        Such expressions like "(a+)+" are prone to catastrophic
+        backtracking.
+        '''
+        repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+        def walk(items, repeated):
+            for op, av in items:
+                if op in repeats:
+                    unbounded = av[1] is sre_parse.MAXREPEAT
+                    if unbounded and repeated:
+                        return True
+                    if walk(av[2], repeated or unbounded):
+                        return True
+                elif op is sre_parse.SUBPATTERN:
+                    if walk(av[-1], repeated):
+                        return True
+                elif op is sre_parse.BRANCH:
+                    if any(walk(branch, repeated) for branch in av[1]):
+                        return True
+                elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                    if walk(av[1], repeated):
+                        return True
+                # possessive and atomic constructs do not backtrack
+            return False
+
+        return walk(sre_parse.parse(regex.pattern, regex.flags), False)
+
     def needs_decision(self):
         return not self.auto or len(self.replacements) > 1
 
+    def matches(self, title):
+        return self.find.search(title) is not None
+
     @classmethod
     def newFromParameters(cls, parameters):
         if '1' not in parameters:
@@ -110,14 +212,28 @@ class TypoRule:
 
         return cls(find, replacements, auto, query)
 
-    def summary_hook(self, match, replaced):
-        def underscores(string):
-            if string.startswith(' '):
-                string = '_' + string[1:]
-            if string.endswith(' '):
-                string = string[:-1] + '_'
-            return string
+    @classmethod
+    def newFromDict(cls, data):
+        return cls(re.compile(data['find'], re.M), data['replacements'],
+                   data['auto'], data['query'])
+
+    def toDict(self):
+        return {
+            'find': self.find.pattern,
+            'replacements': self.replacements,
+            'auto': self.auto,
+            'query': self.query,
+        }
+
+    @staticmethod
+    def underscores(string):
+        if string.startswith(' '):
+            string = '_' + string[1:]
+        if string.endswith(' '):
+            string = string[:-1] + '_'
+        return string
 
+    def summary_hook(self, match, replaced):
         new = old = match.group()
         if self.needs_decision():
             options = [('keep', 'k')]
@@ -125,11 +241,12 @@ class TypoRule:
             for i, repl in enumerate(self.replacements, start=1):
                 replacement = match.expand(repl)
                 replacements.append(replacement)
-                options.append((f'{i} {underscores(replacement)}', str(i)))
+                options.append(
+                    (f'{i} {self.underscores(replacement)}', str(i)))
             text = match.string
             pre = text[max(0, match.start() - 30):match.start()].rpartition('\n')[2]
             post = text[match.end():match.end() + 30].partition('\n')[0]
-            pywikibot.info(f'{pre}<<lightred>>{old}<<default>>{pos}')
+            pywikibot.info(f'{pre}<<lightred>>{old}<<default>>{post}')
             choice = pywikibot.input_choice('Choose the best replacement',
                                             options, automatic_quit=False,
                                             default='k')
@@ -140,28 +257,477 @@ class TypoRule:
             if old == new:
                 pywikibot.warning(f'No replacement done in string "{old}"')
 
+        self.count_replacement(old, new, replaced)
+        return new
+
+    def count_replacement(self, old, new, replaced):
+        self.match_count += 1
         if old != new:
-            old_str = underscores(old.replace('\n', '\\n'))
-            new_str = underscores(new.replace('\n', '\\n'))
+            self.accepted_count += 1
+            old_str = self.underscores(old.replace('\n', '\\n'))
+            new_str = self.underscores(new.replace('\n', '\\n'))
             fragment = f'{old_str} → {new_str}'
             if fragment.lower() not in map(str.lower, replaced):
                 replaced.append(fragment)
-        return new
 
-    def apply(self, text, replaced=None):
+    def iter_unprotected(self, text, ranges=None):
+        '''Yield matches outside of the protected ranges of text'''
+        if ranges is not None:
+            ranges.update(text)
+        pos = 0
+        spent = 0.0
+        while pos <= len(text):
+            start = time.perf_counter()
+            match = self.find.search(text, pos)
+            spent += time.perf_counter() - start
+            if spent > self.time_budget:
+                # keep what has been found so far
+                self.quarantine(spent)
+                break
+            if not match:
+                break
+            end = ranges and ranges.protected_until(match.start())
+            if end is not None:
+                pos = end
+                continue
+            yield match
+            pos = match.end()
+            if not match.group():
+                pos += 1
+
+    def replace_unprotected(self, text, hook, ranges):
+        parts = []
+        last = 0
+        for match in self.iter_unprotected(text, ranges):
+            parts.append(text[last:match.start()])
+            parts.append(hook(match))
+            last = match.end()
+
+        if not parts:
+            return text
+        parts.append(text[last:])
+        return ''.join(parts)
+
+    def find_spans(self, text, ranges):
+        '''Return (start, end, replacement) of all unprotected matches'''
+        assert not self.needs_decision()
+        return [(*match.span(), match.expand(self.replacements[0]))
+                for match in self.iter_unprotected(text, ranges)]
+
+    def quarantine(self, delta):
+        if not self.quarantined:
+            self.quarantined = True
+            pywikibot.warning(
+                f'Typo rule "{self.find.pattern}" exceeded its time budget '
+                f'({delta:.2f}s), skipping it for the rest of the session')
+
+    def apply(self, text, replaced=None, ranges=None):
+        if self.quarantined:
+            return text
         if replaced is None:
             replaced = []
         hook = lambda match: self.summary_hook(match, replaced)
-        start = time.clock()
-        text = textlib.replaceExcept(
-            text, self.find, hook, self.exceptions, site=self.site)
-        finish = time.clock()
+        start = time.perf_counter()
+        if ranges is None:
+            text = textlib.replaceExcept(
+                text, self.find, hook, self.exceptions, site=self.site)
+        else:
+            text = self.replace_unprotected(text, hook, ranges)
+        finish = time.perf_counter()
         delta = finish - start
-        self.longest = max(delta, self.longest)
-        if delta > 5:
-            pywikibot.warning(f'Slow typo rule "{self.find.pattern}" ({delta})')
+        self.record(delta)
+        # with a decision, the time includes waiting for the user
+        if delta > self.time_budget and not self.needs_decision():
+            self.quarantine(delta)
         return text
 
+    def record(self, delta):
+        self.calls += 1
+        self.total += delta
+        self.longest = max(delta, self.longest)
+        # reservoir sampling keeps memory bounded on long runs
+        if len(self.timings) < self.sample_size:
+            self.timings.append(delta)
+        else:
+            index = random.randrange(self.calls)
+            if index < self.sample_size:
+                self.timings[index] = delta
+
+    def get_stats(self):
+        return {
+            'id': self.id,
+            'find': self.find.pattern,
+            'calls': self.calls,
+            'total': self.total,
+            'p50': percentile(self.timings, 50),
+            'p95': percentile(self.timings, 95),
+            'p99': percentile(self.timings, 99),
+            'longest': self.longest,
+            'matches': self.match_count,
+            'accepted': self.accepted_count,
+            'risky': self.risky,
+            'quarantined': self.quarantined,
+        }
+
+
+class ProtectedRanges:
+
+    '''
+    Parts of a text which typo rules must not touch
+
+    The ranges are computed lazily once per text and shared by all rules,
+    they are only recomputed after the text has changed.
+    '''
+
+    def __init__(self, exceptions, site=None):
+        self.regexes = textlib._get_regexes(exceptions, site)
+        self.text = None
+        self.starts = None
+        self.ends = None
+
+    def update(self, text):
+        if text is not self.text and text != self.text:
+            self.text = text
+            self.starts = self.ends = None
+
+    def build(self):
+        spans = sorted(
+            match.span() for regex in self.regexes
+            for match in regex.finditer(self.text) if match.group())
+        self.starts = []
+        self.ends = []
+        for start, end in spans:
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(end, self.ends[-1])
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def protected_until(self, pos):
+        '''Return end of the protected range containing pos, if any'''
+        if self.starts is None:
+            self.build()
+        i = bisect_right(self.starts, pos) - 1
+        if i >= 0 and pos < self.ends[i]:
+            return self.ends[i]
+        return None
+
+
+class TypoRuleIndex:
+
+    '''
+    Index of typo rules by their literal anchors
+
+    Finds all anchors occurring in a text in a single pass so that only
+    the rules which can possibly match need to be run.
+    '''
+
+    title_cache_size = 10000
+
+    def __init__(self, rules):
+        self.rules = {rule.id: rule for rule in rules}
+        self.title_cache = {}
+        self.unanchored = set()
+        by_anchor = defaultdict(set)
+        for rule in rules:
+            if rule.anchor:
+                by_anchor[rule.anchor].add(rule.id)
+            else:
+                self.unanchored.add(rule.id)
+
+        # the regex only reports the longest anchor at each position,
+        # so an anchor implies all anchors which are its prefixes
+        self.implied = {}
+        for anchor in by_anchor:
+            ids = set()
+            for i in range(1, len(anchor) + 1):
+                ids.update(by_anchor.get(anchor[:i], ()))
+            self.implied[anchor] = ids
+
+        self.regex = None
+        if by_anchor:
+            self.regex = re.compile(
+                '(?=(%s))' % self.trie_pattern(by_anchor))
+
+    @classmethod
+    def trie_pattern(cls, words):
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        return cls._node_pattern(trie)
+
+    @classmethod
+    def _node_pattern(cls, node):
+        alternatives = []
+        chars = []
+        for char in sorted(key for key in node if key):
+            child = node[char]
+            if list(child) == ['']:
+                chars.append(re.escape(char))
+            else:
+                alternatives.append(re.escape(char) + cls._node_pattern(child))
+        if len(chars) == 1:
+            alternatives.append(chars[0])
+        elif chars:
+            alternatives.append('[%s]' % ''.join(chars))
+
+        pattern = '|'.join(alternatives)
+        if '' in node:
+            return f'(?:{pattern})?'
+        if len(alternatives) > 1:
+            return f'(?:{pattern})'
+        return pattern
+
+    def candidates(self, text):
+        '''Return IDs of rules which can match text'''
+        ids = set(self.unanchored)
+        if self.regex:
+            for anchor in set(self.regex.findall(text)):
+                ids.update(self.implied[anchor])
+        return ids
+
+    def title_matches(self, title):
+        '''Return IDs of rules which match title'''
+        ids = self.title_cache.get(title)
+        if ids is None:
+            ids = frozenset(rule_id for rule_id in self.candidates(title)
+                            if self.rules[rule_id].matches(title))
+            if len(self.title_cache) >= self.title_cache_size:
+                self.title_cache.clear()
+            self.title_cache[title] = ids
+        return ids
+
+
+# state of span finding worker processes
+_pool_rules = None
+_pool_ranges = None
+
+
+def init_span_worker(rules, exceptions):
+    global _pool_rules, _pool_ranges
+    _pool_rules = {rule.id: rule for rule in rules}
+    _pool_ranges = ProtectedRanges(exceptions)
+
+
+def find_rule_spans(task):
+    '''Return spans of replacements of a shard of rules in a text'''
+    rule_ids, text = task
+    results = []
+    for rule_id in rule_ids:
+        rule = _pool_rules[rule_id]
+        start = time.perf_counter()
+        spans = rule.find_spans(text, _pool_ranges)
+        delta = time.perf_counter() - start
+        results.append((rule_id, spans, delta, rule.quarantined))
+    return results
+
+
+class TypoRulePool:
+
+    '''
+    Pool of processes applying automatic typo rules at once
+
+    Each process finds the matches of a shard of the rules in the same
+    text. Where matches of different rules overlap, the rule coming first
+    wins, and all replacements are then spliced into the text at once.
+    Unlike in sequential application, a rule does not see replacements
+    made by other rules.
+    '''
+
+    min_length = 50000  # shorter texts are not worth the overhead
+
+    def __init__(self, rules, exceptions, site=None, processes=None):
+        self.rules = [rule for rule in rules if not rule.needs_decision()]
+        self.by_id = {rule.id: rule for rule in self.rules}
+        self.order = {rule.id: i for i, rule in enumerate(self.rules)}
+        self.processes = processes or os.cpu_count()
+        self.pool = Pool(
+            self.processes, init_span_worker,
+            (self.rules, textlib._get_regexes(exceptions, site)))
+
+    def accepts(self, rule, text):
+        return (rule.id in self.by_id and not rule.quarantined
+                and len(text) >= self.min_length)
+
+    def apply(self, text, rule_ids, replaced):
+        '''Apply rules with given IDs to text, return the new text'''
+        rule_ids = sorted(rule_ids, key=self.order.__getitem__)
+        if not rule_ids:
+            return text
+        # round robin, so that shards contain both quick and slow rules
+        shards = [rule_ids[i::self.processes] for i in range(self.processes)]
+        tasks = [(shard, text) for shard in shards if shard]
+
+        found = []
+        for results in self.pool.map(find_rule_spans, tasks):
+            for rule_id, spans, delta, quarantined in results:
+                rule = self.by_id[rule_id]
+                rule.record(delta)
+                if quarantined:
+                    # the worker has already warned
+                    rule.quarantined = True
+                elif delta > rule.time_budget:
+                    rule.quarantine(delta)
+                found.append((self.order[rule_id], spans))
+        found.sort(key=lambda pair: pair[0])
+
+        starts = []
+        ends = []
+        accepted = []
+        for order, spans in found:
+            rule = self.rules[order]
+            for start, end, new in spans:
+                i = bisect_right(starts, start)
+                if i > 0 and ends[i - 1] > start:
+                    continue
+                if i < len(starts) and starts[i] < end:
+                    continue
+                starts.insert(i, start)
+                ends.insert(i, end)
+                accepted.append((start, end, new))
+                rule.count_replacement(text[start:end], new, replaced)
+
+        if not accepted:
+            return text
+        accepted.sort()
+        parts = []
+        last = 0
+        for start, end, new in accepted:
+            parts.append(text[last:start])
+            parts.append(new)
+            last = end
+        parts.append(text[last:])
+        return ''.join(parts)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def apply_typo_rules(text, title, index, ranges, replaced, pool=None,
+                     exclude=(), automatic_only=False, stop=None):
+    '''
+    Apply rules of the index which can match text, return the new text
+
+    Rules matching the title and rules with IDs in exclude are skipped,
+    so are rules which need a decision if automatic_only. If a pool is
+    given, it applies the automatic rules it accepts, the other rules
+    are applied one by one until stop() returns True.
+    '''
+    title_matches = index.title_matches(title)
+    candidates = index.candidates(text)
+    handled = set()
+    if pool:
+        handled = {rule.id for rule in index.rules.values()
+                   if rule.id in candidates and rule.id not in title_matches
+                   and rule.id not in exclude and pool.accepts(rule, text)}
+        if handled:
+            text = pool.apply(text, handled, replaced)
+            candidates = index.candidates(text)
+    for rule in index.rules.values():
+        if rule.id not in candidates or rule.id in handled:
+            continue
+        if rule.id in exclude or rule.id in title_matches:
+            continue
+        if automatic_only and rule.needs_decision():
+            continue
+
+        new_text = rule.apply(text, replaced, ranges)
+        if new_text != text:
+            # replacements could have introduced new anchors
+            text = new_text
+            candidates = index.candidates(text)
+        if stop and stop():
+            break
+    return text
+
+
+class TypoWhitelist:
+
+    '''
+    Titles of pages which should not be fixed
+
+    New false positives are journaled in a local file and saved to the
+    whitelist page in batches.
+    '''
+
+    flush_every = 10
+
+    def __init__(self, page, titles=()):
+        self.page = page
+        self.titles = set(map(self.normalize, titles))
+        self.pending = []
+        self.journal_path = pywikibot.config.datafilepath(
+            f'typos-whitelist-{page.site.dbName()}.txt')
+        # recover false positives which were not saved last time
+        try:
+            with open(self.journal_path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        self.titles.add(self.normalize(line))
+                        self.pending.append(line.strip())
+        except OSError:
+            pass
+
+    @staticmethod
+    def normalize(title):
+        return first_upper(' '.join(title.replace('_', ' ').split()))
+
+    def __contains__(self, title):
+        return self.normalize(title) in self.titles
+
+    def __iter__(self):
+        return iter(self.titles)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def add(self, title):
+        title = self.normalize(title)
+        if title in self.titles:
+            return
+        self.titles.add(title)
+        self.pending.append(title)
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(title + '\n')
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        links = [f'[[{title}]]' for title in self.pending]
+        self.page.text += ''.join(f'\n* {link}' for link in links)
+        self.page.save(summary=', '.join(links))
+        self.pending = []
+        os.remove(self.journal_path)
+
+
+def harvest_search(site, rules, seen_limit=100000):
+    '''
+    Run search queries of rules and yield each found title with the rule
+
+    Titles are yielded as the results come in, only with the first rule
+    which found them. Titles found again are skipped as long as they are
+    among the last seen_limit yielded titles.
+    '''
+    seen = {}  # ordered, the oldest title is dropped first
+    for rule in rules:
+        if rule.query is None or rule.quarantined:
+            continue
+        pywikibot.info(f'Query: "{rule.query}"')
+        for page in site.search(rule.query, namespaces=[0]):
+            title = page.title()
+            if title in seen:
+                continue
+            if len(seen) >= seen_limit:
+                del seen[next(iter(seen))]
+            seen[title] = None
+            yield title, rule
+
 
 class TyposLoader:
 
@@ -170,11 +736,19 @@ class TyposLoader:
     '''Class loading and holding typo rules'''
 
     def __init__(self, site, *, allrules=False, typospage=None,
-                 whitelistpage=None):
+                 whitelistpage=None, cache=True, profile=None):
         self.site = site
         self.load_all = allrules
         self.typos_page_name = typospage
         self.whitelist_page_name = whitelistpage
+        self.use_cache = cache
+        self.profile = profile
+
+    def getTyposPage(self):
+        if self.typos_page_name is None:
+            self.typos_page_name = 'Wikipedie:WPCleaner/Typo'
+
+        return pywikibot.Page(self.site, self.typos_page_name)
 
     def getWhitelistPage(self):
         if self.whitelist_page_name is None:
@@ -182,45 +756,156 @@ class TyposLoader:
 
         return pywikibot.Page(self.site, self.whitelist_page_name)
 
+    @property
+    def cache_path(self):
+        return pywikibot.config.datafilepath(
+            f'typos-cache-{self.site.dbName()}.json')
+
+    def readCache(self, section, page):
+        '''
+        Return cached data for the page if there are any
+
+        The second value tells whether the data are for its latest revision.
+        '''
+        if not self.use_cache:
+            return {}, False
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                entry = json.load(f).get(section, {})
+        except (OSError, ValueError):
+            return {}, False
+        if entry.get('title') != page.title():
+            return {}, False
+        return entry, entry.get('revid') == page.latest_revision_id
+
+    def writeCache(self, section, page, **data):
+        if not self.use_cache:
+            return
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        data.update(title=page.title(), revid=page.latest_revision_id)
+        cache[section] = data
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+    def parseTypos(self, text, known=None):
+        '''
+        Parse typo rules from wikitext
+
+        :param known: mapping of template parameters (serialized) to rules
+            which were already parsed from them
+        :return: list of pairs (serialized parameters, rule)
+        '''
+        known = known or {}
+        text = textlib.removeDisabledParts(
+            text, include=['nowiki'], site=self.site)
+        entries = []
+        for template, fielddict in textlib.extract_templates_and_params(
+                text, remove_disabled_parts=False, strip=False):
+            if template.lower() != 'typo':
+                continue
+            key = json.dumps(fielddict, ensure_ascii=False, sort_keys=True)
+            if key in known:
+                entries.append((key, TypoRule.newFromDict(known[key])))
+                continue
+            try:
+                rule = TypoRule.newFromParameters(fielddict)
+            except IncompleteTypoRuleException as exc:
+                pywikibot.warning(exc.message)  # pwb.exception?
+            except InvalidExpressionException as exc:
+                if 'fixed-width' not in exc.message:
+                    pywikibot.warning('Invalid {} {}: {}'.format(
+                        exc.aspect, fielddict['1'], exc.message))
+            else:
+                entries.append((key, rule))
+        return entries
+
     def loadTypos(self):
         pywikibot.info('Loading typo rules...')
         self.typoRules = []
 
-        if self.typos_page_name is None:
-            self.typos_page_name = 'Wikipedie:WPCleaner/Typo'
-        typos_page = pywikibot.Page(self.site, self.typos_page_name)
+        typos_page = self.getTyposPage()
         if not typos_page.exists():
             # todo: feedback
             return
 
-        text = textlib.removeDisabledParts(
-            typos_page.text, include=['nowiki'], site=self.site)
+        cached, is_current = self.readCache('typos', typos_page)
+        if is_current:
+            rules = [TypoRule.newFromDict(data)
+                     for _, data in cached['rules']]
+        else:
+            entries = self.parseTypos(
+                typos_page.text, dict(cached.get('rules', [])))
+            self.writeCache('typos', typos_page, rules=[
+                (key, rule.toDict()) for key, rule in entries])
+            rules = [rule for _, rule in entries]
+
         load_all = self.load_all is True
-        for template, fielddict in textlib.extract_templates_and_params(
-                text, remove_disabled_parts=False, strip=False):
-            if template.lower() == 'typo':
-                try:
-                    rule = TypoRule.newFromParameters(fielddict)
-                except IncompleteTypoRuleException as exc:
-                    pywikibot.warning(exc.message)  # pwb.exception?
-                except InvalidExpressionException as exc:
-                    if 'fixed-width' not in exc.message:
-                        pywikibot.warning('Invalid {} {}: {}'.format(
-                            exc.aspect, fielddict['1'], exc.message))
-                else:
-                    rule.id = self.top_id
-                    # fixme: cvar or ivar?
-                    self.top_id += 1
-                    if load_all or not rule.needs_decision():
-                        self.typoRules.append(rule)
+        for rule in rules:
+            rule.id = self.top_id
+            # fixme: cvar or ivar?
+            self.top_id += 1
+            if load_all or not rule.needs_decision():
+                self.typoRules.append(rule)
+                # rules from the cache are checked too
+                if rule.risky:
+                    pywikibot.warning(
+                        f'Typo rule "{rule.find.pattern}" contains nested '
+                        'quantifiers and may backtrack excessively')
+
+        if self.profile:
+            self.typoRules = self.sortRules(
+                self.typoRules, load_stats(self.profile))
 
         pywikibot.info(f'{len(self.typoRules)} typo rules loaded')
         return self.typoRules
 
+    @staticmethod
+    def sortRules(rules, stats):
+        '''
+        Order rules so that they make the most replacements per second
+
+        :param stats: rule statistics from a previous run (see
+            TypoRule.get_stats)
+        '''
+        by_pattern = {row['find']: row for row in stats}
+        scores = {}
+        for rule in rules:
+            row = by_pattern.get(rule.find.pattern)
+            if row is None or not int(row['calls']):
+                continue
+            total = float(row['total'])
+            mean = total / int(row['calls'])
+            scores[rule.id] = (int(row['accepted']) / max(total, 1e-6), mean)
+
+        # rules without statistics are expected to perform averagely
+        default = (percentile([score for score, _ in scores.values()], 50),
+                   0.0)
+
+        def sortkey(rule):
+            score, mean = scores.get(rule.id, default)
+            return -score, mean
+
+        pywikibot.info(f'Ordering typo rules by statistics of {len(scores)} '
+                       'rules')
+        return sorted(rules, key=sortkey)
+
     def loadWhitelist(self):
-        self.whitelist = []
+        titles = []
         self.fp_page = self.getWhitelistPage()
         if self.fp_page.exists():
-            for match in re.finditer(r'\[\[([^]|]+)\]\]', self.fp_page.text):
-                self.whitelist.append(match[1].strip())
+            cached, is_current = self.readCache('whitelist', self.fp_page)
+            if is_current:
+                titles = cached['titles']
+            else:
+                for match in re.finditer(r'\[\[([^]|]+)\]\]',
+                                         self.fp_page.text):
+                    titles.append(match[1].strip())
+                self.writeCache('whitelist', self.fp_page, titles=titles)
+        self.whitelist = TypoWhitelist(self.fp_page, titles)
         return self.whitelist
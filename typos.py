@@ -1,10 +1,24 @@
 #!/usr/bin/python
+import json
+import os
 import time
 
+from itertools import islice
+
 import pywikibot
 from pywikibot import pagegenerators
-
-from typoloader import TyposLoader
+from pywikibot.pagegenerators import PreloadingGenerator
+
+from tools import dump_stats
+from typoloader import (
+    ProtectedRanges,
+    TypoRule,
+    TypoRuleIndex,
+    TypoRulePool,
+    TyposLoader,
+    apply_typo_rules,
+    harvest_search,
+)
 from wikitext import WikitextFixingBot
 
 
@@ -15,18 +29,33 @@ class TypoBot(WikitextFixingBot):
 
     Supported parameters:
     * -allrules - use if you want to load rules that need user's decision
+    * -batch - run searches of all rules and process each found page once
+      as the results come in
     * -offset:# - what typo rule do you want to start from
+    * -processes:# - apply automatic rules to long pages in parallel in
+      this many processes
+    * -profile: - file to dump per-rule statistics to (.json or .csv)
     * -quick - use if you want the bot to focus on the current rule,
       ie. skip the page if the rule couldn't be applied
+    * -reorder: - file with statistics from -profile, order rules so that
+      they make the most replacements per second (otherwise page order)
+    * -resume - continue from the state saved by an interrupted run
     * -threshold:# - skip rule when loaded/replaced ratio gets over #
     * -typospage: - what page do you want to load typo rules from
     * -whitelistpage: - what page holds pages which should be skipped
     '''
 
+    checkpoint_every = 10  # pages
+
     def __init__(self, generator, *, offset=0, **kwargs):
         self.available_options.update({
             'allrules': False,
+            'batch': False,
+            'processes': 1,
+            'profile': None,
             'quick': False,
+            'reorder': None,
+            'resume': False,
             'threshold': 10,
             'typospage': None,
             'whitelistpage': None,
@@ -40,15 +69,93 @@ class TypoBot(WikitextFixingBot):
 
         super().__init__(**kwargs)
         self.offset = offset
+        self.searched = self.processed = self.replaced = 0
 
     def setup(self):
         loader = TyposLoader(
             self.site, allrules=self.opt['allrules'],
             typospage=self.opt['typospage'],
-            whitelistpage=self.opt['whitelistpage'])
+            whitelistpage=self.opt['whitelistpage'],
+            profile=self.opt['reorder'])
         self.typoRules = loader.loadTypos()
-        self.fp_page = loader.getWhitelistPage()
+        self.rule_index = TypoRuleIndex(self.typoRules)
+        self.ranges = ProtectedRanges(TypoRule.exceptions, self.site)
+        self.pool = None
+        if self.opt['processes'] > 1:
+            self.pool = TypoRulePool(
+                self.typoRules, TypoRule.exceptions, self.site,
+                self.opt['processes'])
         self.whitelist = loader.loadWhitelist()
+        self.fp_page = self.whitelist.page
+        self.resume_state = None
+        if self.own_generator and self.opt['resume']:
+            self.load_state()
+
+    @property
+    def state_path(self):
+        return pywikibot.config.datafilepath(
+            f'typos-state-{self.site.dbName()}.json')
+
+    def load_state(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            pywikibot.warning('No saved state to resume from')
+            return
+        if state['batch'] != self.opt['batch']:
+            pywikibot.warning('Saved state is from a different mode, '
+                              'not resuming')
+            return
+
+        longest = state['longest']
+        offset = None
+        for i, rule in enumerate(self.typoRules):
+            rule.longest = max(rule.longest, longest.get(rule.find.pattern, 0))
+            if rule.find.pattern == state['rule']:
+                offset = i
+        if offset is None:
+            # the rule was changed, only the offset is reliable
+            pywikibot.warning('The rule of saved state was not found')
+            self.offset = state['offset']
+        else:
+            self.offset = offset
+            self.resume_state = state
+        pywikibot.info(f'Resuming from offset {self.offset}')
+
+    def save_state(self):
+        longest = {rule.find.pattern: rule.longest
+                   for rule in self.typoRules if rule.longest}
+        rule = None
+        if self.offset < len(self.typoRules):
+            rule = self.typoRules[self.offset]
+            longest[rule.find.pattern] = max(self.old_max, rule.longest)
+        state = {
+            'batch': self.opt['batch'],
+            'offset': self.offset,
+            'rule': rule and rule.find.pattern,
+            'searched': self.searched,
+            'processed': self.processed,
+            'replaced': self.replaced,
+            'longest': longest,
+        }
+        path = self.state_path
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def restore_progress(self):
+        '''Restore counters of the current rule from saved state'''
+        self.searched = self.processed = self.replaced = 0
+        state, self.resume_state = self.resume_state, None
+        if state and state['offset'] == self.offset:
+            self.searched = state['searched']
+            self.processed = state['processed']
+            self.replaced = state['replaced']
+
+    def checkpoint(self):
+        if self.searched % self.checkpoint_every == 0:
+            self.save_state()
 
     @property
     def is_rule_accurate(self):
@@ -57,7 +164,15 @@ class TypoBot(WikitextFixingBot):
                   self.processed / threshold < self.replaced)
         return result
 
+    @property
+    def is_batch(self):
+        return self.own_generator and self.opt['batch']
+
     def make_generator(self):
+        if self.opt['batch']:
+            yield from self.make_batch_generator()
+            return
+
         for i, rule in enumerate(self.typoRules[:]):
             if self.offset > i:
                 continue
@@ -67,15 +182,20 @@ class TypoBot(WikitextFixingBot):
             # todo: if not allrules:...
             self.offset = i
             pywikibot.info(f'\nQuery: "{rule.query}"')
-            old_max = rule.longest
+            self.old_max = rule.longest
             rule.longest = 0.0
             self.current_rule = rule
             self.skip_rule = False
-            self.processed = self.replaced = 0
-            for page in self.site.search(rule.query, namespaces=[0]):
-                if self.skip_rule:
+            self.restore_progress()
+            generator = self.site.search(rule.query, namespaces=[0])
+            if self.searched:
+                generator.request['gsroffset'] = self.searched
+            for page in generator:
+                if self.skip_rule or rule.quarantined:
                     break
+                self.searched += 1
                 yield page
+                self.checkpoint()
                 if not self.is_rule_accurate:
                     pywikibot.info(
                         f'Skipped inefficient query "{rule.query}" '
@@ -87,24 +207,51 @@ class TypoBot(WikitextFixingBot):
                 else:
                     percent = (self.replaced / self.processed) * 100
                     pywikibot.info(
-                        f'{percent:.f}% accuracy of query "{rule.query}"')
+                        f'{percent:.1f}% accuracy of query "{rule.query}"')
 
             if self.processed > 0:
                 pywikibot.info(f'Longest match: {rule.longest}s')
-            rule.longest = max(old_max, rule.longest)
+            rule.longest = max(self.old_max, rule.longest)
+        self.offset = len(self.typoRules)
+
+    def make_batch_generator(self):
+        self.old_max = 0.0
+        self.restore_progress()
+        # the search results are ordered, skip pages which were processed
+        found = islice(harvest_search(self.site, self.typoRules[self.offset:]),
+                       self.searched, None)
+        selected = {}
+
+        def pages():
+            for title, rule in found:
+                selected[title] = rule
+                yield pywikibot.Page(self.site, title)
+
+        for page in PreloadingGenerator(pages()):
+            rule = selected.pop(page.title(), None)
+            self.current_rules = [rule] if rule else []
+            self.searched += 1
+            yield page
+            self.checkpoint()
 
     def save_false_positive(self, page):
-        link = page.title(as_link=True)
-        self.fp_page.text += f'\n* {link}'
-        self.fp_page.save(summary=link, asynchronous=True)
-        self.whitelist.append(page.title())
+        self.whitelist.add(page.title())
 
     def skip_page(self, page):
         if page.title() in self.whitelist:
             pywikibot.warning(f'Skipped {page} because it is whitelisted')
             return True
 
-        if self.own_generator and self.current_rule.find.search(page.title()):
+        title_matches = self.rule_index.title_matches(page.title())
+        if self.is_batch:
+            self.current_rules = [rule for rule in self.current_rules
+                                  if rule.id not in title_matches]
+            if not self.current_rules:
+                pywikibot.warning(
+                    f'Skipped {page} because the rules match the title')
+                return True
+        elif (self.own_generator
+                and self.current_rule.id in title_matches):
             pywikibot.warning(
                 f'Skipped {page} because the rule matches the title')
             return True
@@ -124,7 +271,12 @@ class TypoBot(WikitextFixingBot):
         quickly = self.opt['quick'] is True
         start = time.time()
         if self.own_generator:
-            text = self.current_rule.apply(page.text, done_replacements)
+            if self.is_batch:
+                current_rules = self.current_rules
+            else:
+                current_rules = [self.current_rule]
+            for rule in current_rules:
+                text = rule.apply(text, done_replacements, self.ranges)
             if page.text == text:
                 if quickly:
                     pywikibot.info('Typo not found, not fixing another '
@@ -133,19 +285,19 @@ class TypoBot(WikitextFixingBot):
             else:
                 self.replaced += 1
 
-        for rule in self.typoRules:
-            if self.own_generator and rule == self.current_rule:  # __eq__
-                continue
-            if rule.find.search(page.title()):
-                continue
-            if quickly and rule.needs_decision():
-                continue
-
-            text = rule.apply(text, done_replacements)
-            stop = time.time()
-            if quickly and stop - start > 15:
+        def out_of_time():
+            if quickly and time.time() - start > 15:
                 pywikibot.warning('Other typos exceeded 15s, skipping')
-                break
+                return True
+            return False
+
+        exclude = set()
+        if self.own_generator:
+            exclude = {rule.id for rule in current_rules}
+        text = apply_typo_rules(
+            text, page.title(), self.rule_index, self.ranges,
+            done_replacements, pool=self.pool, exclude=exclude,
+            automatic_only=quickly, stop=out_of_time)
 
         self.put_current(
             text, summary='oprava překlepů: %s' % ', '.join(done_replacements))
@@ -157,7 +309,7 @@ class TypoBot(WikitextFixingBot):
         options = [('yes', 'y'), ('no', 'n'), ('all', 'a')]
         if self.fp_page.exists():
             options.append(('false positive', 'f'))
-        if self.own_generator:
+        if self.own_generator and not self.is_batch:
             options.append(('skip rule', 's'))
         options += [('open in browser', 'b'), ('quit', 'q')]
 
@@ -196,6 +348,19 @@ class TypoBot(WikitextFixingBot):
             pywikibot.info(f'{i}. "{rule.find.pattern}" - {rule.longest}')
         if self.own_generator:
             pywikibot.info(f'\nCurrent offset: {self.offset}\n')
+            if self.generator_completed:
+                if os.path.exists(self.state_path):
+                    os.remove(self.state_path)
+            elif hasattr(self, 'old_max'):
+                self.save_state()
+                pywikibot.info('State saved, use -resume to continue')
+        self.whitelist.flush()
+        if self.pool:
+            self.pool.close()
+        if self.opt['profile']:
+            dump_stats([rule.get_stats() for rule in self.typoRules],
+                       self.opt['profile'])
+            pywikibot.info(f"Rule statistics saved to {self.opt['profile']}")
         super().teardown()
 
 
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+"""
+Benchmark of typo rules on a frozen corpus of articles
+
+Make a snapshot of the typo rules and some articles (needs network),
+any page generator can be used:
+
+    python pwb.py typos_benchmark -snapshot:<dir> -random:300
+
+Then run the benchmark offline (no site is needed):
+
+    python pwb.py typos_benchmark -corpus:<dir> -repeat:3 -output:<file>
+
+The rules are applied the same way as by TypoBot and TypoFix. No corpus
+is part of the repository (articles and rules change), so results are
+only comparable when run on the same snapshot directory, its digest is
+reported with the results.
+
+Supported parameters:
+* -corpus: - directory with the snapshot to run the benchmark on
+* -output: - file to dump per-rule results to (.json or .csv)
+* -processes:# - apply automatic rules to long pages in parallel in
+  this many processes
+* -repeat:# - how many times to run the benchmark, the fastest run is
+  reported
+* -snapshot: - directory to save the snapshot to
+* -top:# - how many slowest rules to show
+"""
+import hashlib
+import json
+import os
+import re
+import time
+
+import pywikibot
+
+from pywikibot import pagegenerators, textlib
+
+from tools import dump_stats
+from typoloader import (
+    ProtectedRanges,
+    TypoRule,
+    TypoRuleIndex,
+    TypoRulePool,
+    TyposLoader,
+    apply_typo_rules,
+)
+
+TYPOS_FILE = 'typos.txt'
+EXCEPTIONS_FILE = 'exceptions.json'
+ARTICLES_FILE = 'articles.jsonl'
+
+
+def make_snapshot(site, directory, generator):
+    os.makedirs(directory, exist_ok=True)
+    typos_page = TyposLoader(site).getTyposPage()
+    with open(os.path.join(directory, TYPOS_FILE), 'w',
+              encoding='utf-8') as f:
+        f.write(typos_page.text)
+
+    # site-dependent exceptions are frozen so that no site is needed later
+    exceptions = [(regex.pattern, regex.flags) for regex in
+                  textlib._get_regexes(TypoRule.exceptions, site)]
+    with open(os.path.join(directory, EXCEPTIONS_FILE), 'w',
+              encoding='utf-8') as f:
+        json.dump(exceptions, f, ensure_ascii=False, indent=2)
+
+    count = 0
+    with open(os.path.join(directory, ARTICLES_FILE), 'w',
+              encoding='utf-8') as f:
+        for page in generator:
+            if not page.exists() or page.isRedirectPage():
+                continue
+            json.dump({'title': page.title(), 'text': page.text}, f,
+                      ensure_ascii=False)
+            f.write('\n')
+            count += 1
+    pywikibot.info(f'Saved {count} articles to {directory}')
+
+
+class TypoBenchmark:
+
+    '''Offline run of all automatic typo rules on a frozen corpus'''
+
+    def __init__(self, directory, processes=1):
+        self.directory = directory
+        self.processes = processes
+        digest = hashlib.sha1()
+        for name in (TYPOS_FILE, EXCEPTIONS_FILE, ARTICLES_FILE):
+            with open(os.path.join(directory, name), 'rb') as f:
+                digest.update(f.read())
+        self.digest = digest.hexdigest()
+
+        with open(os.path.join(directory, TYPOS_FILE),
+                  encoding='utf-8') as f:
+            self.typos_text = f.read()
+        with open(os.path.join(directory, EXCEPTIONS_FILE),
+                  encoding='utf-8') as f:
+            self.exceptions = [re.compile(pattern, flags)
+                               for pattern, flags in json.load(f)]
+        with open(os.path.join(directory, ARTICLES_FILE),
+                  encoding='utf-8') as f:
+            self.articles = [json.loads(line) for line in f if line.strip()]
+        self.size = sum(len(article['text'].encode('utf-8'))
+                        for article in self.articles)
+
+    def load_rules(self):
+        loader = TyposLoader(None, cache=False)
+        rules = [rule for _, rule in loader.parseTypos(self.typos_text)
+                 if not rule.needs_decision()]
+        for i, rule in enumerate(rules):
+            rule.id = i
+        return rules
+
+    def run_once(self):
+        rules = self.load_rules()
+        index = TypoRuleIndex(rules)
+        ranges = ProtectedRanges(self.exceptions)
+        pool = None
+        if self.processes > 1:
+            pool = TypoRulePool(rules, self.exceptions,
+                                processes=self.processes)
+        try:
+            start = time.perf_counter()
+            for article in self.articles:
+                apply_typo_rules(article['text'], article['title'], index,
+                                 ranges, [], pool=pool)
+            elapsed = time.perf_counter() - start
+        finally:
+            if pool:
+                pool.close()
+        return elapsed, rules
+
+    def run(self, repeat=1):
+        best = None
+        for i in range(repeat):
+            result = self.run_once()
+            pywikibot.info(f'Run {i + 1}: {result[0]:.3f}s')
+            if best is None or result[0] < best[0]:
+                best = result
+        elapsed, rules = best
+
+        rows = [{
+            'id': 'total',
+            'find': self.digest,
+            'calls': len(self.articles),
+            'total': elapsed,
+            'pages/s': len(self.articles) / elapsed,
+            'MB/s': self.size / elapsed / 1e6,
+            'matches': sum(rule.match_count for rule in rules),
+        }]
+        for rule in rules:
+            total = rule.total
+            rows.append({
+                'id': rule.id,
+                'find': rule.find.pattern,
+                'calls': rule.calls,
+                'total': total,
+                'pages/s': rule.calls / total if total else 0.0,
+                'matches': rule.match_count,
+            })
+        return rows
+
+
+def main(*args):
+    options = {}
+    local_args = pywikibot.handle_args(args)
+    genFactory = pagegenerators.GeneratorFactory()
+    for arg in genFactory.handle_args(local_args):
+        if arg.startswith('-'):
+            arg, sep, value = arg.partition(':')
+            if value != '':
+                options[arg[1:]] = value if not value.isdigit() else int(value)
+            else:
+                options[arg[1:]] = True
+
+    if options.get('snapshot'):
+        genFactory.handle_arg('-ns:0')
+        generator = genFactory.getCombinedGenerator(preload=True)
+        if not generator:
+            pywikibot.error('A generator of articles is needed')
+            return
+        make_snapshot(pywikibot.Site(), options['snapshot'], generator)
+        return
+
+    if not options.get('corpus'):
+        pywikibot.error('Either -snapshot or -corpus is needed')
+        return
+
+    benchmark = TypoBenchmark(options['corpus'], options.get('processes', 1))
+    pywikibot.info(f'Corpus {benchmark.digest}: {len(benchmark.articles)} '
+                   f'pages, {benchmark.size / 1e6:.2f} MB')
+    rows = benchmark.run(options.get('repeat', 1))
+    total, rule_rows = rows[0], rows[1:]
+    pywikibot.info(f"Total: {total['total']:.3f}s, "
+                   f"{total['pages/s']:.1f} pages/s, {total['MB/s']:.2f} MB/s")
+    pywikibot.info('\nSlowest rules:')
+    rule_rows.sort(key=lambda row: row['total'], reverse=True)
+    for row in rule_rows[:options.get('top', 10)]:
+        pywikibot.info(f"\"{row['find']}\" - {row['total']:.3f}s, "
+                       f"{row['pages/s']:.1f} pages/s, "
+                       f"{row['matches']} matches")
+    if options.get('output'):
+        dump_stats(rows, options['output'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 #!/usr/bin/python
+import time
+
 from itertools import chain
 from operator import methodcaller
 
@@ -8,6 +10,7 @@ from pywikibot import pagegenerators
 from pywikibot.bot import SingleSiteBot, ExistingPageBot
 
 from custome_fixes import all_fixes
+from tools import dump_stats
 
 
 class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
@@ -21,9 +24,15 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
 
     You can enable each fix by using its name as a command line argument
     or all fixes using -all (then, each used fix is excluded).
+
+    Time spent in each fix is summarized at the end, use -fixprofile:
+    to dump the statistics to a file (.json or .csv).
     '''
 
     def __init__(self, **kwargs):
+        self.available_options.update({
+            'fixprofile': None,
+        })
         do_all = kwargs.pop('all', False) is True
         self.fixes = []
         for fix, cls in all_fixes.items():
@@ -40,6 +49,7 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
                 self.fixes.append(cls(**options))
 
         self.fixes.sort(key=lambda fix: fix.order)
+        self.fix_stats = {}
 
         super().__init__(**kwargs)
         for fix in self.fixes:
@@ -66,10 +76,55 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
 
     def applyFixes(self, page, summaries=[]):
         callbacks = []
+        text = page.text
+        size = len(text.encode('utf-8'))
         for fix in self.fixes:
+            start = time.perf_counter()
+            cpu = time.process_time()
             fix.apply(page, summaries, callbacks)
+            changed = page.text != text
+            self.record_fix(fix, time.perf_counter() - start,
+                            time.process_time() - cpu, size, changed)
+            if changed:
+                text = page.text
+                size = len(text.encode('utf-8'))
         return callbacks
 
+    def record_fix(self, fix, wall, cpu, size, changed):
+        key = fix.key or type(fix).__name__
+        if key not in self.fix_stats:
+            self.fix_stats[key] = {
+                'fix': key,
+                'calls': 0,
+                'wall': 0.0,
+                'cpu': 0.0,
+                'bytes': 0,
+                'changed': 0,
+            }
+        stats = self.fix_stats[key]
+        stats['calls'] += 1
+        stats['wall'] += wall
+        stats['cpu'] += cpu
+        stats['bytes'] += size
+        stats['changed'] += changed
+
+    def teardown(self):
+        rows = sorted(self.fix_stats.values(),
+                      key=lambda stats: stats['wall'], reverse=True)
+        if rows:
+            pywikibot.info('\nTime spent in fixes:')
+        for stats in rows:
+            percent = (stats['changed'] / stats['calls']) * 100
+            pywikibot.info(
+                f"{stats['fix']}: {stats['wall']:.2f}s "
+                f"(CPU {stats['cpu']:.2f}s), {stats['calls']} pages, "
+                f"{stats['bytes'] / 1e6:.1f} MB, {percent:.1f}% changed")
+        if self.opt['fixprofile']:
+            dump_stats(rows, self.opt['fixprofile'])
+            pywikibot.info(
+                f"Fix statistics saved to {self.opt['fixprofile']}")
+        super().teardown()
+
     def userPut(self, page, oldtext, newtext, **kwargs):
         if oldtext.rstrip() == newtext.rstrip():
             pywikibot.info(